@@ -8,8 +8,22 @@
 - (可选) `sendNotify.py` 用于发送通知，需要配置相应的 Secrets。
 """
 import os
+import re
+import json
+import math
 import time
+import base64
+import hashlib
 import random
+import queue
+import argparse
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, fields, replace
+from datetime import date, datetime, timezone
+from typing import Optional
+from urllib.parse import urlparse
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -31,16 +45,130 @@ except ImportError:
         print("--- End Notification ---")
 # --- End Notification Setup ---
 
+# --- Optional Session Cache Encryption ---
+# `pip install cryptography` and set E5_SESSION_KEY to enable the session cache
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
 List = [] # To store output messages
 
 # --- Configuration ---
-LOGIN_URL = 'https://admin.microsoft.com/'
-SUBSCRIPTIONS_URL = 'https://admin.microsoft.com/Adminportal/Home?source=applauncher#/subscriptions'
+# Endpoints can be pointed elsewhere, e.g. at a local stand-in of the sign-in and Admin Center pages
+LOGIN_URL = os.environ.get('E5_LOGIN_URL', 'https://admin.microsoft.com/')
+SUBSCRIPTIONS_URL = os.environ.get(
+    'E5_SUBSCRIPTIONS_URL', 'https://admin.microsoft.com/Adminportal/Home?source=applauncher#/subscriptions')
+# Hosts that tell the Admin Center apart from the sign-in pages in the current URL
+ADMIN_HOST = urlparse(LOGIN_URL).netloc
+SIGNIN_HOST = os.environ.get('E5_SIGNIN_HOST', 'login.microsoftonline.com')
 TARGET_SUBSCRIPTION_NAME = "Microsoft 365 E5" 
 # Adjust if your E5 subscription name is slightly different
+# Products tracked on the subscriptions page as `label=regex` pairs separated by ';', matched
+# case-insensitively against card titles, e.g. E5_PRODUCTS="E5=Microsoft 365 E5;E3=Office 365 E3;Dev=Developer"
+PRODUCTS = os.environ.get('E5_PRODUCTS', f'E5={re.escape(TARGET_SUBSCRIPTION_NAME)}')
+# How to read an ambiguous numeric date like 01/02/2026: 'mdy' (en-US) or 'dmy' (en-GB, fr, es, ...).
+# A first field above 12 is always read as the day.
+DATE_ORDER = os.environ.get('E5_DATE_ORDER', 'mdy').strip().lower()
+# Browser profile: 'full' loads everything, 'lean' blocks images, media, fonts and telemetry
+BROWSER_PROFILE = os.environ.get('E5_BROWSER_PROFILE', 'full').strip().lower()
+# Per-phase page-load bytes for comparing profiles (E5_PAGE_METRICS=1); needs Chrome's performance log,
+# which costs log traffic and memory on every page, so it is off by default
+PAGE_METRICS = os.environ.get('E5_PAGE_METRICS', '0') == '1'
+# URL patterns blocked via CDP in the lean profile; the script only reads text nodes
+LEAN_BLOCKED_URLS = [
+    '*.png*', '*.jpg*', '*.jpeg*', '*.gif*', '*.webp*', '*.ico*',
+    '*.mp4*', '*.webm*', '*.mp3*',
+    '*.woff*', '*.woff2*', '*.ttf*', '*.otf*', '*.eot*',
+    '*browser.events.data.microsoft.com*', '*mobile.events.data.microsoft.com*',
+    '*browser.pipe.aria.microsoft.com*', '*js.monitor.azure.com*',
+    '*dc.services.visualstudio.com*', '*.clarity.ms*',
+    '*google-analytics.com*', '*googletagmanager.com*',
+]
+# Sign-in challenge form shown instead of the password prompt when MS suspects automation
+THROTTLE_ELEMENT_IDS = ('HipEnforcementForm', 'hipTemplateContainer')
+# Local state (session cache, ...) kept between runs, e.g. via actions/cache
+STATE_DIR = os.environ.get('E5_STATE_DIR', '.e5_state')
+# Cached sessions older than this are ignored; the default outlives the weekly schedule
+SESSION_TTL_HOURS = 192
+# One JSON record per checked account, written as soon as the account finishes
+RESULTS_FILE = os.environ.get('E5_RESULTS_FILE', 'e5_results.jsonl')
+# Throttle backoff in seconds: first delay and cap, override with E5_THROTTLE_BACKOFF="base=30,max=600".
+# min_interval spaces out logins on the same tenant even without throttling (0 = no pacing).
+THROTTLE_BACKOFF = {'base': 30, 'max': 600, 'min_interval': 0}
+# Retries allowed per failure phase within a run, override with E5_RETRY_BUDGET="password=1,...".
+# A wrong password rarely fixes itself, a crashed Chrome usually does.
+RETRY_BUDGET = {'webdriver': 3, 'email': 2, 'password': 0, 'throttled': 2,
+                'navigation': 2, 'extraction': 2, 'unexpected': 1}
+# How much of that budget is spent immediately, override with E5_INLINE_RETRIES="navigation=1,...".
+# Every retry past the sign-in page is another login, so those phases wait for a --resume run.
+INLINE_RETRIES = {'webdriver': 3, 'email': 0, 'password': 0, 'throttled': 2,
+                  'navigation': 0, 'extraction': 0, 'unexpected': 0}
+# First backoff (seconds) before retrying each phase, doubled per retry; E5_RETRY_BACKOFF overrides.
+# Throttled retries wait for the tenant's own backoff from the ThrottleScheduler instead.
+RETRY_BACKOFF = {'webdriver': 5, 'email': 15, 'password': 30, 'throttled': 0,
+                 'navigation': 15, 'extraction': 10, 'unexpected': 10}
+# Text on sign-in pages that means Microsoft is throttling or challenging the login
+THROTTLE_PATTERNS = re.compile('|'.join((
+    r'too many (?:requests|attempts|times)', r"you've tried to sign in too many times",
+    r'unusual (?:activity|sign-in)', r'captcha', r'enter the characters you see',
+    r'AADSTS50053', r'AADSTS50196', r'AADSTS90055',
+    r'请求过多', r'尝试次数过多', r'登录次数过多', r'异常活动', r'输入你看到的字符',
+)), re.IGNORECASE)
+# Tenant GUID in the sign-in/token URLs the Admin Center requests after login
+TENANT_ID_PATTERN = re.compile(
+    r'(?:login\.microsoftonline\.com|login\.windows\.net)/'
+    r'([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?:/|$)', re.IGNORECASE)
+# Identifies this run in the checkpoint files; re-runs of a GitHub workflow share the run ID
+RUN_ID = (os.environ.get('E5_RUN_ID') or os.environ.get('GITHUB_RUN_ID')
+          or datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ'))
+# What --shard hashes: 'email' spreads accounts evenly, 'domain' keeps each tenant's accounts
+# in one shard (one shared lookup per tenant, but a big tenant then fills a single shard)
+SHARD_BY = os.environ.get('E5_SHARD_BY', 'email').strip().lower()
+# Checkpoint files of this many most recent runs are kept in STATE_DIR/checkpoints
+CHECKPOINT_KEEP = 5
+# A browser warmed up on the login page longer ago than this (seconds) loads it again
+PRENAVIGATED_MAX_AGE = 300
+# Failure screenshots (JPEG) and trimmed DOM snapshots go here, within a per-run budget
+# that E5_ARTIFACT_BUDGET="count=50,megabytes=100" overrides
+ARTIFACT_DIR = os.environ.get('E5_ARTIFACT_DIR', 'e5_artifacts')
+ARTIFACT_BUDGET = {'count': 20, 'megabytes': 25}
+ARTIFACT_JPEG_QUALITY = 60
+ARTIFACT_DOM_CHARS = 200_000
+# Notifications: results expiring within urgent_days (or failing) are sent as soon as the
+# account finishes; reports are split into messages of at most max_chars. Each send gets
+# `timeout` seconds and `retries` retries. Override with E5_NOTIFY="urgent_days=14,...".
+NOTIFY_DEFAULTS = {'urgent_days': 7, 'max_chars': 3500, 'retries': 2, 'timeout': 30}
+# Prefix of the metrics files written at the end of a run (<prefix>.json and <prefix>.prom)
+METRICS_PREFIX = os.environ.get('E5_METRICS_PREFIX', 'e5_metrics')
+# Incremental scheduling: accounts this close to expiry (days) are checked on every run,
+# and no account goes longer than the full-refresh interval without a successful check
+NEAR_EXPIRY_DAYS = 30
+FULL_REFRESH_DAYS = 28
+# Container elements for each subscription on the 'Your products' page
+SUBSCRIPTION_CARD_SELECTOR = "div[role='row'], div[data-automation-id^='DetailsCard']"
+# Resource Timing entries kept per page, so network_idle() keeps seeing new requests
+RESOURCE_TIMING_BUFFER_SIZE = 5000
+# Upper bounds (seconds) for the readiness waits, override with E5_WAIT_TIMEOUTS="redirect=30,..."
+READINESS_TIMEOUTS = {'email': 10, 'password': 5, 'redirect': 20, 'subscriptions': 15}
+# The fixed random sleeps the readiness waits replaced, kept as the baseline for the savings report
+FIXED_SLEEPS = {'email': (3, 5), 'password': (0.5, 0.5), 'redirect': (4, 7), 'subscriptions': (2, 4)}
 
 # --- Helper Function ---
-def get_webdriver():
+def apply_browser_profile(driver):
+    """Applies per-tab CDP settings; call again for every new tab."""
+    # Resource Timing keeps only 250 entries by default and the Admin Center loads more,
+    # after which network_idle() would see no new requests and report idle too early
+    driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {
+        'source': f'performance.setResourceTimingBufferSize({RESOURCE_TIMING_BUFFER_SIZE});',
+    })
+    if BROWSER_PROFILE != 'lean':
+        return
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': LEAN_BLOCKED_URLS})
+
+
+def get_webdriver(log):
     options = webdriver.ChromeOptions()
     # Crucial options for GitHub Actions/headless environments
     options.add_argument("--headless") 
@@ -49,106 +177,2199 @@ def get_webdriver():
     options.add_argument("--window-size=1920,1080")
     # Use a common user agent
     options.add_argument("user-agent=Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.127 Safari/537.36") 
+    if PAGE_METRICS:
+        # Network events in the performance log are what PageMetrics sums bytes from
+        options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+    if BROWSER_PROFILE == 'lean':
+        # Return from get() at DOMContentLoaded; every wait below is explicit anyway
+        options.page_load_strategy = 'eager'
+        options.add_experimental_option('prefs', {
+            'profile.managed_default_content_settings.images': 2,
+        })
     
     # In GitHub Actions with apt install, chromedriver should be in PATH
+    driver = None
     try:
        # Let Selenium find chromedriver in PATH
        driver = webdriver.Chrome(options=options) 
-       List.append("  - WebDriver 初始化成功。")
+       count_round_trips(driver)
+       apply_browser_profile(driver)
+       log.append(f"  - WebDriver 初始化成功 ({BROWSER_PROFILE} 模式)。")
        return driver
     except WebDriverException as e:
-       List.append(f"!! 错误：无法初始化WebDriver: {e}")
-       List.append("!! 请检查工作流中的 ChromeDriver 安装步骤。")
-       return None
+       log.append(f"!! 错误：无法初始化WebDriver: {e}")
+       log.append("!! 请检查工作流中的 ChromeDriver 安装步骤。")
     except Exception as e:
-       List.append(f"!! 错误：初始化WebDriver时发生意外错误: {e}")
-       return None
+       log.append(f"!! 错误：初始化WebDriver时发生意外错误: {e}")
+    # Chrome may already be running if setting up the profile failed; don't orphan it
+    if driver is not None:
+        try:
+            driver.quit()
+        except Exception:
+            pass
+    return None
 
 
-def check_e5_expiry(username, password):
-    """Logs into Microsoft Admin Center and checks E5 subscription expiry."""
-    List.append(f"开始检查账号: {username}")
-    driver = get_webdriver()
-    if not driver:
-        List.append(f"!! 检查失败: {username} (WebDriver 初始化失败)")
-        return 
+# --- Page Load Metrics ---
+class PageLoadStats:
+    """Run-wide bytes and wall time per page-load phase, for comparing browser profiles."""
 
-    try:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = {} # phase -> [count, bytes, seconds, blocked]
+
+    def record(self, phase, size, seconds, blocked):
+        with self._lock:
+            totals = self.phases.setdefault(phase, [0, 0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += size
+            totals[2] += seconds
+            totals[3] += blocked
+
+    def summary(self):
+        if not self.phases:
+            return f"  - 页面负载 ({BROWSER_PROFILE} 模式): 无数据。"
+        lines = [f"  - 页面负载 ({BROWSER_PROFILE} 模式):"]
+        for phase, (count, size, seconds, blocked) in self.phases.items():
+            lines.append(f"    {phase}: 平均 {size / count / 1024:.0f} KB, {seconds / count:.1f} 秒, "
+                         f"拦截请求 {blocked / count:.0f} 个 ({count} 次)")
+        return '\n'.join(lines)
+
+
+page_load_stats = PageLoadStats()
+
+
+class PageMetrics:
+    """Splits one account's network traffic and wall time into named phases.
+
+    Bytes come from Network.loadingFinished events in Chrome's performance
+    log, which also covers cross-origin responses that Resource Timing hides.
+    Draining the log at each mark attributes everything since the previous
+    mark to the phase being closed.
+    """
+
+    def __init__(self, driver, log):
+        self.driver = driver
+        self.log = log
+        self._drain() # Discard traffic from before this account (pooled or pre-warmed browser)
+        self._started = time.monotonic()
+
+    def _drain(self):
+        size = blocked = 0
+        try:
+            entries = self.driver.get_log('performance')
+        except Exception:
+            return 0, 0
+        for entry in entries:
+            message = json.loads(entry['message'])['message']
+            if message['method'] == 'Network.loadingFinished':
+                size += message['params'].get('encodedDataLength', 0)
+            elif message['method'] == 'Network.loadingFailed' and message['params'].get('blockedReason'):
+                blocked += 1
+        return int(size), blocked
+
+    def mark(self, phase):
+        """Closes `phase`, logging the bytes and time it took."""
+        size, blocked = self._drain()
+        now = time.monotonic()
+        seconds, self._started = now - self._started, now
+        page_load_stats.record(phase, size, seconds, blocked)
+        self.log.append(f"  - 页面负载 [{phase}]: {size / 1024:.0f} KB, {seconds:.1f} 秒, 拦截 {blocked} 个请求")
+
+
+# --- Phase Timing ---
+def count_round_trips(driver):
+    """Wraps driver.execute so every WebDriver command bumps `driver.e5_round_trips`.
+
+    WebElement methods call back into their parent driver's execute(), so
+    element lookups, clicks and scripts are all counted.
+    """
+    execute = driver.execute
+
+    def counting_execute(driver_command, params=None):
+        driver.e5_round_trips += 1
+        return execute(driver_command, params)
+
+    driver.e5_round_trips = 0
+    driver.execute = counting_execute
+
+
+class PhaseTimer:
+    """Lap timer for one account check: entering a phase closes the previous one.
+
+    Seconds and WebDriver round trips per phase are accumulated into the
+    result's `timings` and `round_trips` dicts.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        self.driver = None
+        self._phase = None
+        self._started = 0.0
+        self._trips_at = None
+
+    def _trips(self):
+        return getattr(self.driver, 'e5_round_trips', 0)
+
+    def attach(self, driver):
+        """Starts counting round trips on `driver` from this point of the current phase."""
+        self.driver = driver
+        if self._phase is not None and self._trips_at is None:
+            self._trips_at = self._trips()
+
+    def enter(self, phase):
+        self.stop()
+        self._phase = phase
+        self._started = time.monotonic()
+        self._trips_at = self._trips() if self.driver is not None else None
+
+    def stop(self):
+        if self._phase is None:
+            return
+        phase, self._phase = self._phase, None
+        seconds = time.monotonic() - self._started
+        trips = self._trips() - self._trips_at if self._trips_at is not None else 0
+        timings, round_trips = self.result.timings, self.result.round_trips
+        timings[phase] = round(timings.get(phase, 0.0) + seconds, 3)
+        round_trips[phase] = round_trips.get(phase, 0) + trips
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+class RunMetrics:
+    """Collects per-phase durations and round trips across the run and exports them."""
+
+    QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.durations = {} # phase -> [seconds, ...]
+        self.round_trips = {} # phase -> total commands
+        self.statuses = {}
+
+    def record(self, phase, seconds, trips=0):
+        with self._lock:
+            self.durations.setdefault(phase, []).append(seconds)
+            self.round_trips[phase] = self.round_trips.get(phase, 0) + trips
+
+    def record_result(self, result):
+        for phase, seconds in result.timings.items():
+            self.record(phase, seconds, result.round_trips.get(phase, 0))
+        with self._lock:
+            self.statuses[result.status] = self.statuses.get(result.status, 0) + 1
+
+    def snapshot(self):
+        """Aggregated view: count, sum, quantiles and round trips per phase."""
+        with self._lock:
+            phases = {}
+            for phase, values in self.durations.items():
+                values = sorted(values)
+                phases[phase] = {
+                    'count': len(values),
+                    'sum': round(sum(values), 3),
+                    'max': round(values[-1], 3),
+                    'quantiles': {str(q): round(percentile(values, q), 3) for q in self.QUANTILES},
+                    'round_trips': self.round_trips.get(phase, 0),
+                }
+            return {
+                'started_at': datetime.fromtimestamp(self.started, timezone.utc).isoformat(timespec='seconds'),
+                'run_seconds': round(time.time() - self.started, 3),
+                'accounts': dict(self.statuses),
+                'phases': phases,
+            }
+
+    @staticmethod
+    def to_prometheus(snapshot):
+        lines = [
+            '# HELP e5_phase_duration_seconds Wall time of each account-check phase.',
+            '# TYPE e5_phase_duration_seconds summary',
+        ]
+        for phase, stats in snapshot['phases'].items():
+            for q, value in stats['quantiles'].items():
+                lines.append(f'e5_phase_duration_seconds{{phase="{phase}",quantile="{q}"}} {value}')
+            lines.append(f'e5_phase_duration_seconds_sum{{phase="{phase}"}} {stats["sum"]}')
+            lines.append(f'e5_phase_duration_seconds_count{{phase="{phase}"}} {stats["count"]}')
+        lines += [
+            '# HELP e5_phase_round_trips_total WebDriver commands issued in each phase.',
+            '# TYPE e5_phase_round_trips_total counter',
+        ]
+        for phase, stats in snapshot['phases'].items():
+            lines.append(f'e5_phase_round_trips_total{{phase="{phase}"}} {stats["round_trips"]}')
+        lines += [
+            '# HELP e5_accounts_total Accounts checked in this run by result status.',
+            '# TYPE e5_accounts_total counter',
+        ]
+        for status, count in snapshot['accounts'].items():
+            lines.append(f'e5_accounts_total{{status="{status}"}} {count}')
+        lines += [
+            '# HELP e5_run_duration_seconds Wall time of the whole run.',
+            '# TYPE e5_run_duration_seconds gauge',
+            f'e5_run_duration_seconds {snapshot["run_seconds"]}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def export(self, prefix):
+        """Writes <prefix>.json and <prefix>.prom; returns the report lines for the summary."""
+        snapshot = self.snapshot()
+        with open(f"{prefix}.json", 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, indent=2)
+        with open(f"{prefix}.prom", 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus(snapshot))
+        lines = [f"  - 阶段耗时 (p50 / p90 / max 秒, WebDriver 往返次数), 指标已写入 {prefix}.json/.prom:"]
+        for phase, stats in snapshot['phases'].items():
+            q = stats['quantiles']
+            lines.append(f"    {phase}: {q['0.5']:.1f} / {q['0.9']:.1f} / {stats['max']:.1f}, "
+                         f"{stats['round_trips']} 次 ({stats['count']} 个样本)")
+        return '\n'.join(lines)
+
+
+run_metrics = RunMetrics()
+
+
+# --- Browser Session Pool ---
+def reset_browser_state(driver):
+    """Moves the browser into a new, empty browser context so the next account starts clean.
+
+    Cookies, storage and cache belong to the context, so dropping the previous
+    one also wipes origins the last sign-in passed through that no list here
+    would name, such as a federated identity provider.
+    """
+    old_context = getattr(driver, 'e5_browser_context', None)
+    old_handles = driver.window_handles
+    context = driver.execute_cdp_cmd('Target.createBrowserContext', {})['browserContextId']
+    target = driver.execute_cdp_cmd('Target.createTarget', {'url': 'about:blank', 'browserContextId': context})
+    # ChromeDriver's window handles are DevTools target IDs
+    driver.switch_to.window(target['targetId'])
+    driver.e5_browser_context = context
+    if old_context is not None:
+        # Closes that context's tabs along with its data
+        driver.execute_cdp_cmd('Target.disposeBrowserContext', {'browserContextId': old_context})
+    else:
+        # The launch tab lives in the default context, which cannot be disposed of
+        for handle in old_handles:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(target['targetId'])
+    apply_browser_profile(driver)
+
+
+class DriverPool:
+    """Lends headless browsers to accounts and prepares the next one in the background.
+
+    `size` browsers serve the accounts being checked; up to `max_browsers` may
+    be alive at once, the extra ones launching or resetting while the current
+    accounts are still running. Background browsers are pre-navigated to the
+    login page so sign_in() can skip that load (see take_prenavigated).
+    """
+
+    def __init__(self, size, max_browsers=None, prewarm=True):
+        self.size = size
+        self.max_browsers = max(1, max_browsers or size + 1)
+        self.prewarm = prewarm
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._live = 0
+        self._warming = 0
+        self._pending = 0
+        self._background = ThreadPoolExecutor(max_workers=self.max_browsers, thread_name_prefix='e5-warmup')
+        self.launches = 0
+        self.reuses = 0
+        self.replaced = 0
+        self.prenavigated = 0
+        self.launch_seconds = 0.0
+        self.reset_seconds = 0.0
+        self.background_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    @classmethod
+    def from_env(cls, size):
+        """Pool of `size` with the browser cap from E5_MAX_BROWSERS and E5_PREWARM=0 to turn warm-up off."""
+        prewarm = os.environ.get('E5_PREWARM', '1') != '0'
+        max_browsers = parse_number_env('E5_MAX_BROWSERS', size + 1 if prewarm else size)
+        return cls(size, max(1, max_browsers), prewarm)
+
+    def take_prenavigated(self, driver):
+        """True (once) if `driver` was parked on the login page recently enough to sign in there."""
+        at = getattr(driver, 'e5_prenavigated_at', None)
+        driver.e5_prenavigated_at = None
+        if at is None or time.monotonic() - at > PRENAVIGATED_MAX_AGE:
+            return False
+        with self._lock:
+            self.prenavigated += 1
+        return True
+
+    def expect(self, count):
+        """Tells the pool how many more accounts will ask for a browser, so it warms no more than that."""
+        with self._lock:
+            self._pending = count
+
+    def _launch(self, log):
+        start = time.monotonic()
+        driver = get_webdriver(log)
+        with self._lock:
+            if driver is None:
+                self._live -= 1
+                return None
+            self.launches += 1
+            self.launch_seconds += time.monotonic() - start
+        return driver
+
+    def _discard(self, driver):
+        with self._lock:
+            self._live -= 1
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_alive(driver):
+        try:
+            driver.current_url # Any round trip fails once Chrome or the session has died
+            return True
+        except WebDriverException:
+            return False
+
+    @staticmethod
+    def _prenavigate(driver):
         driver.get(LOGIN_URL)
-        # Increased wait time for potentially slow cloud environments
-        wait = WebDriverWait(driver, 45) 
+        driver.e5_prenavigated_at = time.monotonic()
+
+    def _warm_up(self):
+        """Background task: launches a browser, opens the login page and parks it as idle."""
+        start = time.monotonic()
+        driver = self._launch([])
+        try:
+            if driver is not None:
+                try:
+                    self._prenavigate(driver)
+                except WebDriverException:
+                    pass # Still a usable browser; sign_in() will load the page itself
+                self._idle.put(driver)
+        finally:
+            with self._lock:
+                self._warming -= 1
+                self.background_seconds += time.monotonic() - start
+
+    def _recycle(self, driver):
+        """Background task: resets a released browser, pre-navigates it if accounts remain and parks it."""
+        start = time.monotonic()
+        driver.e5_prenavigated_at = None
+        try:
+            reset_browser_state(driver)
+            with self._lock:
+                self.reset_seconds += time.monotonic() - start
+                wanted = self._pending > 0
+            # A login page loaded for no one is wasted traffic, and it goes stale anyway
+            if self.prewarm and wanted:
+                self._prenavigate(driver)
+        except Exception:
+            self._discard(driver)
+        else:
+            self._idle.put(driver)
+        finally:
+            with self._lock:
+                self._warming -= 1
+                self.background_seconds += time.monotonic() - start
+
+    def _schedule_warm_up(self):
+        """Starts one more browser in the background if accounts are waiting and the cap allows."""
+        if not self.prewarm:
+            return
+        with self._lock:
+            if self._live >= self.max_browsers or self._pending <= self._idle.qsize() + self._warming:
+                return
+            self._live += 1
+            self._warming += 1
+        self._background.submit(self._warm_up)
+
+    def acquire(self, log):
+        """Returns an idle browser, launching one while below the cap; None if launch fails."""
+        with self._lock:
+            self._pending = max(self._pending - 1, 0)
+        waited_from = None
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    # Wait for a warming browser rather than launching a second one for the same account
+                    can_launch = self._live < self.max_browsers and (
+                        self._warming == 0 or self._live < self.size)
+                    if can_launch:
+                        self._live += 1
+                if can_launch:
+                    driver = self._launch(log)
+                    self._schedule_warm_up()
+                    return driver
+                waited_from = waited_from or time.monotonic()
+                try:
+                    # Time out now and then: a background launch may fail and free its slot
+                    driver = self._idle.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+            if waited_from is not None:
+                with self._lock:
+                    self.wait_seconds += time.monotonic() - waited_from
+                waited_from = None
+            if self._is_alive(driver):
+                with self._lock:
+                    self.reuses += 1
+                log.append("  - 复用已启动的浏览器会话。")
+                self._schedule_warm_up()
+                return driver
+            log.append("!! 浏览器会话已崩溃或失效，正在替换...")
+            with self._lock:
+                self.replaced += 1
+            self._discard(driver)
+
+    def release(self, driver, log):
+        """Hands a browser back; it is reset (and pre-navigated) in the background, or quit on failure."""
+        with self._lock:
+            self._warming += 1
+        self._background.submit(self._recycle, driver)
+        log.append("  - 浏览器已交回，在后台重置。")
+
+    def close(self):
+        self._background.shutdown(wait=True)
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(driver)
+
+    def summary(self):
+        """Log lines on how much Chrome startup time reuse and background warm-up saved."""
+        if not self.launches:
+            return "  - 浏览器池: 未成功启动任何浏览器。"
+        avg_launch = self.launch_seconds / self.launches
+        saved = avg_launch * self.reuses - self.reset_seconds
+        line = (f"  - 浏览器池: 启动 {self.launches} 次 (平均 {avg_launch:.1f} 秒), "
+                f"复用 {self.reuses} 次, 替换失效会话 {self.replaced} 次, "
+                f"约节省启动时间 {max(saved, 0.0):.1f} 秒。")
+        if self.prewarm:
+            overlap = max(self.background_seconds - self.wait_seconds, 0.0)
+            line += (f"\n  - 浏览器预热 (最多 {self.max_browsers} 个浏览器): 后台准备 {self.background_seconds:.1f} 秒, "
+                     f"账号等待浏览器 {self.wait_seconds:.1f} 秒, 与检查重叠约 {overlap:.1f} 秒, "
+                     f"跳过登录页加载 {self.prenavigated} 次。")
+        return line
+
+
+# --- Readiness Waits ---
+def parse_kv_env(env_var, defaults, cast=float):
+    """Overlays `key=value,key2=value2` from an env var onto a copy of `defaults`."""
+    values = dict(defaults)
+    for item in os.environ.get(env_var, '').split(','):
+        key, sep, raw = item.partition('=')
+        key = key.strip()
+        if not sep or key not in values:
+            continue
+        try:
+            values[key] = cast(raw.strip())
+        except ValueError:
+            List.append(f'!! 警告：{env_var} 中 {key}="{raw.strip()}" 无效，使用默认值 {values[key]}。')
+    return values
+
+
+def parse_number_env(env_var, default, cast=int):
+    """Reads a single number from an env var, warning and keeping `default` if it's invalid."""
+    raw = os.environ.get(env_var, '').strip()
+    if not raw:
+        return default
+    try:
+        return cast(raw)
+    except ValueError:
+        List.append(f'!! 警告：{env_var}="{raw}" 无效，使用默认值 {default}。')
+        return default
+
+
+def document_ready(driver):
+    return driver.execute_script("return document.readyState") == 'complete'
+
+
+def animations_finished(driver):
+    """Expected condition: no finite CSS animation or transition is still running.
+
+    Infinite ones (loading spinners) never finish, so they are left out.
+    """
+    return driver.execute_script(
+        "return document.getAnimations().filter(a => a.playState === 'running'"
+        " && a.effect && a.effect.getComputedTiming().endTime !== Infinity).length === 0")
+
+
+def on_host(host):
+    """Expected condition: the current URL's host is exactly `host`.
 
-        # --- Login Step 1: Enter Email ---
-        try:
-            email_field = wait.until(EC.visibility_of_element_located((By.ID, "i0116")))
-            email_field.send_keys(username)
-            # Use JavaScript click as a fallback if direct click fails
-            next_button = wait.until(EC.element_to_be_clickable((By.ID, "idSIButton9")))
-            driver.execute_script("arguments[0].click();", next_button)
-            # next_button.click() # Direct click sometimes fails
-            List.append("  - 输入邮箱并点击下一步")
-        except (NoSuchElementException, TimeoutException) as e:
-            List.append(f"!! 错误：找不到邮箱输入框或超时。页面可能更改。 {e}")
-            driver.save_screenshot(f"error_email_input_{username}.png") 
-            return # Stop check for this user
-
-        time.sleep(random.uniform(3, 5)) # Wait for password or other prompts
-
-        # --- Login Step 2: Enter Password ---
-        try:
-            password_field = wait.until(EC.visibility_of_element_located((By.ID, "i0118")))
-            time.sleep(0.5)
-            password_field.send_keys(password)
-            signin_button = wait.until(EC.element_to_be_clickable((By.ID, "idSIButton9")))
-            driver.execute_script("arguments[0].click();", signin_button)
-            # signin_button.click() 
-            List.append("  - 输入密码并点击登录")
-        except (NoSuchElementException, TimeoutException) as e:
-            # Check if it's asking for password again (common if email format was slightly off or domain federated)
+    A substring test would also match the sign-in page, whose redirect_uri
+    query parameter carries the Admin Center's address.
+    """
+    def condition(driver):
+        return urlparse(driver.current_url).netloc == host
+    return condition
+
+
+def network_idle(idle_ms=500):
+    """True once the document is loaded and no resource has finished for `idle_ms`.
+
+    Resource Timing only lists finished requests, so this is a quiet-period
+    heuristic rather than a count of in-flight requests. Its buffer is enlarged
+    on every page by apply_browser_profile().
+    """
+    def condition(driver):
+        return driver.execute_script("""
+            if (document.readyState !== 'complete') return false;
+            const entries = performance.getEntriesByType('resource');
+            const lastEnd = entries.reduce((m, e) => Math.max(m, e.responseEnd), 0);
+            return performance.now() - lastEnd >= arguments[0];
+        """, idle_ms)
+    return condition
+
+
+class WaitStats:
+    """Run-wide tally of time spent in readiness waits versus the old fixed sleeps."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.waited = 0.0
+        self.baseline = 0.0
+        self.timeouts = 0
+
+    def record(self, step, elapsed, timed_out):
+        low, high = FIXED_SLEEPS[step]
+        with self._lock:
+            self.waited += elapsed
+            self.baseline += (low + high) / 2
+            self.timeouts += timed_out
+
+    def summary(self):
+        return (f"  - 就绪等待: 共等待 {self.waited:.1f} 秒, 固定休眠预计 {self.baseline:.1f} 秒, "
+                f"节省 {self.baseline - self.waited:.1f} 秒 (超时 {self.timeouts} 次)。")
+
+
+wait_stats = WaitStats()
+readiness_timeouts = parse_kv_env('E5_WAIT_TIMEOUTS', READINESS_TIMEOUTS)
+
+
+def wait_until_ready(driver, log, step, condition):
+    """Waits for `condition` up to the step's configured bound instead of sleeping blindly.
+
+    A timeout is not an error: the flow continues exactly as it did after the
+    fixed sleep, and the next explicit wait decides whether the step failed.
+    """
+    timeout = readiness_timeouts[step]
+    start = time.monotonic()
+    timed_out = False
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=0.2).until(condition)
+    except TimeoutException:
+        timed_out = True
+        log.append(f"  - 等待 '{step}' 就绪超时 ({timeout:g} 秒)，继续...")
+    wait_stats.record(step, time.monotonic() - start, timed_out)
+
+
+# --- Throttle-Aware Pacing ---
+def tenant_domain(username):
+    """Tenant key for pacing: the email domain, lower-cased."""
+    return username.rpartition('@')[2].strip().lower()
+
+
+def detect_tenant_id(driver):
+    """Tenant GUID from the current URL or the token requests of the signed-in page, or None."""
+    try:
+        urls = driver.execute_script(
+            "return [location.href].concat(performance.getEntriesByType('resource').map(e => e.name));")
+    except WebDriverException:
+        return None
+    for url in urls or []:
+        match = TENANT_ID_PATTERN.search(url)
+        if match:
+            return match.group(1).lower()
+    return None
+
+
+def detect_throttle(driver):
+    """Returns a short reason if the current page is a throttle/CAPTCHA page, else None."""
+    try:
+        page = driver.execute_script(
+            "return {text: (document.body ? document.body.innerText : '').slice(0, 5000),"
+            " ids: arguments[0].filter(id => document.getElementById(id))};",
+            list(THROTTLE_ELEMENT_IDS))
+    except WebDriverException:
+        return None
+    match = THROTTLE_PATTERNS.search(page.get('text') or '')
+    if match:
+        return match.group(0)
+    if page.get('ids'):
+        return 'CAPTCHA'
+    return None
+
+
+class ThrottleScheduler:
+    """Paces logins per tenant domain and backs off only where throttling was seen.
+
+    Every domain starts with no delay. A throttle event on a domain pushes its
+    next allowed login out by an exponential, jittered backoff; a clean login
+    resets it. Other domains are never delayed by it.
+    """
+
+    def __init__(self, base, max_delay, min_interval=0):
+        self.base = base
+        self.max_delay = max_delay
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_allowed = {} # domain -> monotonic time
+        self._strikes = {} # domain -> consecutive throttle events
+        self.events = 0
+        self.waited = 0.0
+
+    def wait_turn(self, domain, log):
+        """Blocks until `domain` may log in again and reserves the slot."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_allowed.get(domain, now))
+            self._next_allowed[domain] = start + self.min_interval
+            delay = start - now
+            self.waited += delay
+        if delay > 0:
+            log.append(f"  -- 租户 {domain} 限流退避/节流，等待 {delay:.1f} 秒 --")
+            time.sleep(delay)
+            run_metrics.record('throttle_wait', delay)
+        return delay
+
+    def report_throttle(self, domain, reason, log):
+        """Records a throttle event and pushes the domain's next login out."""
+        with self._lock:
+            strikes = self._strikes.get(domain, 0) + 1
+            self._strikes[domain] = strikes
+            ceiling = min(self.max_delay, self.base * 2 ** (strikes - 1))
+            backoff = random.uniform(ceiling / 2, ceiling) # "Equal jitter" keeps a floor under the delay
+            self._next_allowed[domain] = max(self._next_allowed.get(domain, 0.0), time.monotonic() + backoff)
+            self.events += 1
+        log.append(f"!! 租户 {domain} 触发限流 ({reason})，第 {strikes} 次，退避 {backoff:.1f} 秒。")
+        return backoff
+
+    def report_ok(self, domain):
+        with self._lock:
+            self._strikes.pop(domain, None)
+
+    def summary(self):
+        return f"  - 限流调度: 检测到 {self.events} 次限流事件, 累计退避/节流等待 {self.waited:.1f} 秒。"
+
+
+throttle_backoff = parse_kv_env('E5_THROTTLE_BACKOFF', THROTTLE_BACKOFF)
+throttle_scheduler = ThrottleScheduler(
+    throttle_backoff['base'], throttle_backoff['max'], throttle_backoff['min_interval'])
+
+
+# --- Subscription Card Extraction ---
+# Collects every card's title, status and expiry text in the page, so the whole
+# products list costs one WebDriver round trip instead of several per card.
+EXTRACT_CARDS_JS = """
+const text = el => el ? (el.innerText || el.textContent || '').trim() : '';
+return Array.from(document.querySelectorAll(arguments[0]), card => {
+    const title = card.querySelector(
+        "div[data-automation-id='ProductTitle'], span[data-automation-id='ProductName']");
+    return {
+        title: title ? text(title) : null,
+        status: text(card.querySelector("[data-automation-id*='Status']")),
+        end_date: text(card.querySelector("[data-automation-id='SubscriptionEndDate']")),
+        text: text(card).slice(0, 2000),
+    };
+});
+"""
+
+# A card line that states when the subscription ends, in the Admin Center's display languages
+EXPIRY_LABEL_PATTERN = re.compile(
+    r'expir|end date|ends on|到期|过期|期限|läuft|ablauf|vence|scade|만료',
+    re.IGNORECASE)
+
+
+def extract_subscription_cards(driver):
+    """Returns a list of {title, status, end_date, text} dicts, one per card."""
+    return driver.execute_script(EXTRACT_CARDS_JS, SUBSCRIPTION_CARD_SELECTOR) or []
+
+
+def compile_products(spec):
+    """Compiles `label=regex;...` into one alternation with a named group per product.
+
+    One search per card then tells which product it is; when several patterns
+    match the same title, the one listed first wins.
+    """
+    labels, branches = [], []
+    for item in spec.split(';'):
+        label, sep, pattern = item.partition('=')
+        label, pattern = label.strip(), pattern.strip()
+        if not sep or not label or not pattern:
+            continue
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            List.append(f'!! 警告：E5_PRODUCTS 中 {label} 的正则无效 ({e})，已忽略。')
+            continue
+        branches.append(f'(?P<p{len(labels)}>{pattern})')
+        labels.append(label)
+    return labels, re.compile('|'.join(branches) or r'(?!)', re.IGNORECASE)
+
+
+def match_products(cards):
+    """Pairs every card whose title is a tracked product with that product's label."""
+    matched = []
+    for card in cards:
+        match = PRODUCT_MATCHER.search(card['title'] or '')
+        if match:
+            matched.append((PRODUCT_LABELS[int(match.lastgroup[1:])], card))
+    return matched
+
+
+def card_expiry_text(card):
+    """The card's dated expiry line, else its end-date field, else any expiry line, else None."""
+    lines = [line.strip() for line in (card.get('text') or '').splitlines() if EXPIRY_LABEL_PATTERN.search(line)]
+    dated = [line for line in lines if parse_expiry_date(line)]
+    return next((text for text in dated + [card.get('end_date')] + lines if text), None)
+
+
+PRODUCT_LABELS, PRODUCT_MATCHER = compile_products(PRODUCTS)
+
+
+# --- Expiry Date Parsing ---
+# English, German, French and Spanish month names and abbreviations
+MONTH_NAMES = {name: i for i, names in enumerate((
+    ('jan', 'january', 'januar', 'janv', 'janvier', 'ene', 'enero'),
+    ('feb', 'february', 'februar', 'févr', 'février', 'febrero'),
+    ('mar', 'march', 'mär', 'märz', 'mars', 'marzo'),
+    ('apr', 'april', 'avr', 'avril', 'abr', 'abril'),
+    ('may', 'mai', 'mayo'),
+    ('jun', 'june', 'juni', 'juin', 'junio'),
+    ('jul', 'july', 'juli', 'juil', 'juillet', 'julio'),
+    ('aug', 'august', 'août', 'ago', 'agosto'),
+    ('sep', 'sept', 'september', 'septembre', 'septiembre'),
+    ('oct', 'october', 'okt', 'oktober', 'octobre', 'octubre'),
+    ('nov', 'november', 'novembre', 'noviembre'),
+    ('dec', 'december', 'dez', 'dezember', 'déc', 'décembre', 'dic', 'diciembre'),
+), 1) for name in names}
+
+# (pattern, order of the captured year/month/day groups), tried in this order
+EXPIRY_DATE_PATTERNS = (
+    (re.compile(r'(\d{4})\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*日'), 'ymd'), # zh / ja
+    (re.compile(r'(\d{4})\s*년\s*(\d{1,2})\s*월\s*(\d{1,2})\s*일'), 'ymd'), # ko
+    (re.compile(r'\b(\d{4})[-/.]\s?(\d{1,2})[-/.]\s?(\d{1,2})\b'), 'ymd'),
+    (re.compile(r'\b(\d{1,2})\.\s?(\d{1,2})\.\s?(\d{4})\b'), 'dmy'), # de
+    (re.compile(r'\b(\d{1,2})/(\d{1,2})/(\d{4})\b'), None), # mdy or dmy, see numeric_date_order()
+    (re.compile(r'\b([^\W\d_]{3,9})\.?\s+(\d{1,2}),?\s+(\d{4})\b'), 'mdy'),
+    (re.compile(r'\b(\d{1,2})\.?\s+(?:de\s+)?([^\W\d_]{3,10})\.?,?\s+(?:de\s+)?(\d{4})\b'), 'dmy'),
+)
+
+
+def numeric_date_order(first, second):
+    """Order of a `first/second/year` date: the field above 12 is the day, else DATE_ORDER."""
+    if int(first) > 12:
+        return 'dmy'
+    if int(second) > 12:
+        return 'mdy'
+    return 'dmy' if DATE_ORDER == 'dmy' else 'mdy'
+
+
+def parse_expiry_date(text):
+    """Extracts the first recognisable date from an expiry string, or None."""
+    for pattern, order in EXPIRY_DATE_PATTERNS:
+        for match in pattern.finditer(text or ''):
+            parts = dict(zip(order or numeric_date_order(*match.groups()[:2]), match.groups()))
+            month = parts['m']
+            month = MONTH_NAMES.get(month.lower()) if not month.isdigit() else int(month)
+            if not month:
+                continue
             try:
-                if driver.find_element(By.ID, "i0118").is_displayed():
-                   List.append("!! 警告: 似乎仍在密码页面，密码可能错误或登录流程异常。")
-                else: raise NoSuchElementException # Re-raise if not the password field
-            except NoSuchElementException:
-                List.append(f"!! 错误：找不到密码输入框或登录按钮。密码错误或页面结构更改。 {e}")
-            driver.save_screenshot(f"error_password_input_{username}.png")
+                return date(int(parts['y']), month, int(parts['d']))
+            except ValueError:
+                continue
+    return None
+
+
+# --- Failure Artifacts ---
+# Page markup without scripts, styles, images or form values: enough to see which
+# element a selector missed, small enough to keep many of them. `key` identifies the page
+# layout for dedup: host and path without the per-request query, and the element skeleton
+# (tags, ids, classes) without any text, so the account's own email doesn't make it unique.
+TRIMMED_DOM_JS = """
+const root = document.documentElement.cloneNode(true);
+root.querySelectorAll('script, style, noscript, svg, link, meta, iframe, img').forEach(e => e.remove());
+root.querySelectorAll('input').forEach(e => e.removeAttribute('value'));
+const skeleton = el => el.tagName + (el.id ? '#' + el.id : '') +
+    (typeof el.className === 'string' && el.className ? '.' + el.className.trim().split(/\\s+/).join('.') : '') +
+    (el.children.length ? '(' + Array.from(el.children, skeleton).join(',') + ')' : '');
+return {
+    dom: location.href + '\\n' + root.outerHTML.slice(0, arguments[0]),
+    key: location.host + location.pathname + '\\n' + skeleton(root),
+};
+"""
+
+
+class ArtifactStore:
+    """Captures failure screenshots and DOM snapshots, writing them on a background thread.
+
+    Only the two WebDriver calls run on the worker's path. A capture whose
+    trimmed DOM matches an earlier one is skipped, since a broken layout makes
+    every account fail on the same page, and the run stops capturing once the
+    count or size budget is spent. File names use account_key(), never the email.
+    """
+
+    def __init__(self, directory, max_count, max_bytes):
+        self.directory = directory
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = None
+        self._hashes = set()
+        self.saved = self.saved_bytes = self.duplicates = self.over_budget = 0
+
+    @classmethod
+    def from_env(cls):
+        budget = parse_kv_env('E5_ARTIFACT_BUDGET', ARTIFACT_BUDGET)
+        return cls(ARTIFACT_DIR, int(budget['count']), int(budget['megabytes'] * 1024 * 1024))
+
+    def capture(self, driver, step, username, log):
+        """Snapshots the current page for `step`; never raises."""
+        try:
+            page = driver.execute_script(TRIMMED_DOM_JS, ARTIFACT_DOM_CHARS) or {}
+        except WebDriverException as e:
+            log.append(f"!! (附加错误) 读取页面 DOM 失败: {e}")
             return
+        dom = page.get('dom') or ''
+        # Hash the layout, not the content: URLs and pages carry per-request and per-account values
+        digest = hashlib.sha256((page.get('key') or dom).encode('utf-8')).hexdigest()
+        with self._lock:
+            if digest in self._hashes:
+                self.duplicates += 1
+                log.append(f"  - 失败现场与之前的相同，不再保存 ({step})。")
+                return
+            if self.saved >= self.max_count or self.saved_bytes >= self.max_bytes:
+                self.over_budget += 1
+                return
+            self._hashes.add(digest)
+            self.saved += 1
+            sequence = self.saved
+        try:
+            screenshot = driver.execute_cdp_cmd(
+                'Page.captureScreenshot', {'format': 'jpeg', 'quality': ARTIFACT_JPEG_QUALITY})['data']
+        except WebDriverException as e:
+            log.append(f"!! (附加错误) 截图失败: {e}")
+            screenshot = None
+        stem = os.path.join(self.directory, f"{sequence:03d}_{account_key(username)}_{re.sub(r'[^a-z0-9_]', '_', step)}")
+        with self._lock:
+            # Base64 is a third larger than the JPEG, so this charges slightly more than is written
+            self.saved_bytes += len(dom) + len(screenshot or '')
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='e5-artifacts', daemon=True)
+                self._writer.start()
+        self._queue.put((stem, dom, screenshot))
+        log.append(f"  - 已记录失败现场: {stem}.html{' / .jpg' if screenshot else ''}")
+
+    def _write_loop(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            stem, dom, screenshot = item
+            try:
+                with open(f"{stem}.html", 'w', encoding='utf-8') as f:
+                    f.write(dom)
+                if screenshot:
+                    with open(f"{stem}.jpg", 'wb') as f:
+                        f.write(base64.b64decode(screenshot))
+            except OSError as e:
+                print(f"!! 保存失败现场 {stem} 失败: {e}")
 
-        # --- Login Step 3: Handle "Stay signed in?" (KMSI) ---
+    def close(self):
+        """Waits for queued artifacts to be written."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def summary(self):
+        line = (f"失败现场: 保存 {self.saved} 份 ({self.saved_bytes / 1024:.0f} KB) 到 {self.directory}, "
+                f"重复跳过 {self.duplicates} 份")
+        if self.over_budget:
+            line += f", 超出预算未保存 {self.over_budget} 份"
+        return line
+
+
+artifact_store = ArtifactStore.from_env()
+
+
+# --- Result Records ---
+@dataclass
+class AccountResult:
+    """Outcome of one account check; serialised as one line of the results file."""
+    account: str
+    status: str = 'pending' # ok | not_found | failed | skipped
+    failure_phase: Optional[str] = None # webdriver | email | password | throttled | navigation | extraction | unexpected
+    error: Optional[str] = None
+    product_title: Optional[str] = None
+    expiry_text: Optional[str] = None
+    expiry: Optional[str] = None # ISO date
+    days_remaining: Optional[int] = None
+    products: list = field(default_factory=list) # one dict per tracked product found, see add_product()
+    tenant_id: Optional[str] = None # seen after login, see detect_tenant_id()
+    source_account: Optional[str] = None # set when the lookup was done by another account of the tenant
+    attempts: int = 1
+    timings: dict = field(default_factory=dict) # phase -> seconds
+    round_trips: dict = field(default_factory=dict) # phase -> WebDriver commands
+    checked_at: str = field(default_factory=lambda: datetime.now(timezone.utc).isoformat(timespec='seconds'))
+
+    def add_product(self, label, title, status, expiry_text):
+        """Records a tracked product; the top-level expiry fields follow the soonest expiry."""
+        expiry = parse_expiry_date(expiry_text)
+        product = {'label': label, 'title': title, 'status': status or None, 'expiry_text': expiry_text,
+                   'expiry': expiry.isoformat() if expiry else None,
+                   'days_remaining': (expiry - date.today()).days if expiry else None}
+        self.products.append(product)
+        self.status = 'ok'
+        if self.product_title is None or (expiry and (self.expiry is None or product['expiry'] < self.expiry)):
+            self.product_title = title
+            self.expiry_text = expiry_text
+            self.expiry = product['expiry']
+            self.days_remaining = product['days_remaining']
+        return product
+
+    def fail(self, phase, log, status='failed'):
+        """Marks the check as failed in `phase`, keeping the last error logged; returns self."""
+        self.status = status
+        self.failure_phase = phase
+        error = next((line.strip() for line in reversed(log) if line.lstrip().startswith('!!')), None)
+        # Selenium messages go on with a stacktrace; the log keeps it, the record needs the first line
+        self.error = error.split('\n', 1)[0].strip() if error else None
+        return self
+
+
+class ResultWriter:
+    """Appends result records to a JSONL file, one flushed line per finished account."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def write(self, result):
+        line = json.dumps(asdict(result), ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_results(path):
+    """Yields result dicts from a JSONL results file, one line at a time."""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def format_result(record):
+    """Renders one result record as a line of the human-readable report."""
+    if record['status'] == 'ok':
+        products = record.get('products') or [{'label': None, 'title': record['product_title'],
+                                                'expiry': record['expiry'], 'expiry_text': record['expiry_text'],
+                                                'days_remaining': record['days_remaining']}]
+        parts = []
+        for product in products:
+            expiry = (f"到期 {product['expiry']} (剩余 {product['days_remaining']} 天)" if product['expiry']
+                      else f"有效期: {product['expiry_text']}")
+            parts.append(f"{product['title']} | {expiry}")
+        line = f"  - {record['account']}: 正常 | " + '; '.join(parts)
+        return f"{line} (同租户 {record['source_account']})" if record.get('source_account') else line
+    if record['status'] == 'skipped':
+        return f"  - {record['account']}: 跳过 ({record['error']})"
+    label = '未找到订阅' if record['status'] == 'not_found' else '失败'
+    line = f"  - {record['account']}: {label} (阶段: {record['failure_phase']})"
+    if record.get('source_account'):
+        line += f" (同租户 {record['source_account']})"
+    return f"{line} {record['error']}" if record['error'] else line
+
+
+def summarize_results(path):
+    """Builds the report text by streaming over the results file."""
+    counts = {}
+    lines = []
+    for record in read_results(path):
+        counts[record['status']] = counts.get(record['status'], 0) + 1
+        lines.append(format_result(record))
+    header = (f"检查结果: 共 {sum(counts.values())} 个账号, 正常 {counts.get('ok', 0)}, "
+              f"未找到订阅 {counts.get('not_found', 0)}, 失败 {counts.get('failed', 0)}, "
+              f"跳过 {counts.get('skipped', 0)}")
+    return '\n'.join(['', header] + lines)
+
+
+def merge_results(paths, out_path, expected_accounts=None):
+    """Combines per-shard result files into `out_path`; returns report lines on the merge.
+
+    The first record per account wins. Accounts listed in `expected_accounts`
+    but found in no shard are reported as missing.
+    """
+    if os.path.abspath(out_path) in {os.path.abspath(path) for path in paths}:
+        raise ValueError(f"合并输出文件 {out_path} 不能同时作为输入")
+    seen, duplicates, problems = set(), [], []
+    with open(out_path, 'w', encoding='utf-8') as out:
+        for path in paths:
+            try:
+                for record in read_results(path):
+                    key = record['account'].strip().lower()
+                    if key in seen:
+                        duplicates.append(record['account'])
+                        continue
+                    seen.add(key)
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            except (OSError, ValueError) as e:
+                problems.append(f"!! 无法读取分片结果 {path}: {e}")
+    lines = [f"合并 {len(paths)} 个分片结果: 共 {len(seen)} 个账号。"] + problems
+    if duplicates:
+        lines.append(f"!! 重复的账号结果 (已忽略): {', '.join(duplicates)}")
+    if expected_accounts is not None:
+        missing = [name for name in expected_accounts if name.strip().lower() not in seen]
+        if missing:
+            lines.append(f"!! 以下账号没有任何分片结果: {', '.join(missing)}")
+    return lines
+
+
+result_writer = None # Set in __main__
+
+
+# --- Checkpoint and Resume ---
+class Checkpoint:
+    """Append-only JSONL log of every account attempt in one run, for --resume.
+
+    Each run gets its own file under STATE_DIR/checkpoints named after the run
+    ID; a line is flushed as soon as an attempt finishes, so the log survives a
+    cancelled runner or a crashed browser.
+    """
+
+    def __init__(self, run_id, directory=None):
+        self.run_id = run_id
+        self.directory = directory or os.path.join(STATE_DIR, 'checkpoints')
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', run_id)}.jsonl")
+        self._lock = threading.Lock()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def latest_run_id(directory=None):
+        """Run ID of the most recently written checkpoint, or None."""
+        directory = directory or os.path.join(STATE_DIR, 'checkpoints')
+        try:
+            paths = [os.path.join(directory, n) for n in os.listdir(directory) if n.endswith('.jsonl')]
+        except OSError:
+            return None
+        for path in sorted(paths, key=os.path.getmtime, reverse=True):
+            for record in read_results(path):
+                return record['run_id']
+        return None
+
+    def prune(self, keep=CHECKPOINT_KEEP):
+        """Deletes all but the `keep` most recent checkpoint files."""
+        paths = sorted((os.path.join(self.directory, n) for n in os.listdir(self.directory) if n.endswith('.jsonl')),
+                       key=os.path.getmtime, reverse=True)
+        for path in paths[keep:]:
+            if os.path.abspath(path) != os.path.abspath(self.path):
+                os.remove(path)
+
+    def append(self, result):
+        record = dict(asdict(result), run_id=self.run_id)
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def load(self):
+        """Returns {account_key: {'last': record, 'failures': {phase: count}}} for this run."""
+        progress = {}
+        for record in read_results(self.path):
+            entry = progress.setdefault(account_key(record['account']), {'last': None, 'failures': {}})
+            entry['last'] = record
+            if record['status'] == 'failed':
+                phase = record['failure_phase']
+                entry['failures'][phase] = entry['failures'].get(phase, 0) + 1
+        return progress
+
+    def close(self):
+        self._file.close()
+
+
+def result_from_record(record):
+    """Rebuilds an AccountResult from a checkpoint line, ignoring fields this version doesn't know."""
+    known = {f.name for f in fields(AccountResult)}
+    return AccountResult(**{k: v for k, v in record.items() if k in known})
+
+
+def retry_allowed(failures, phase):
+    """True while `phase` has failed no more often than its retry budget allows."""
+    return failures.get(phase, 0) <= retry_budget.get(phase, 0)
+
+
+def retry_inline(failures, phase):
+    """True while this run may retry `phase` right away instead of leaving it to --resume."""
+    return failures.get(phase, 0) <= inline_retries.get(phase, 0)
+
+
+retry_budget = parse_kv_env('E5_RETRY_BUDGET', RETRY_BUDGET, cast=int)
+inline_retries = parse_kv_env('E5_INLINE_RETRIES', INLINE_RETRIES, cast=int)
+retry_backoff = parse_kv_env('E5_RETRY_BACKOFF', RETRY_BACKOFF)
+checkpoint = None # Set in __main__
+
+
+# --- State Files ---
+def write_json_atomic(path, data):
+    """Writes `data` as JSON through a temp file, so a crash never leaves `path` half-written."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+# --- Tenant Deduplication ---
+class TenantDirectory:
+    """Maps accounts to the tenant ID seen after their last login (STATE_DIR/tenants.json).
+
+    Accounts of one tenant share its subscriptions, so the runner looks them up
+    once per tenant. Until an account's tenant ID is known, its email domain
+    (or the ID already seen for that domain) stands in for it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+
+    @classmethod
+    def from_env(cls):
+        if os.environ.get('E5_TENANT_DEDUP', '1') == '0':
+            return None
+        return cls(os.path.join(STATE_DIR, 'tenants.json'))
+
+    def group(self, accounts):
+        """Splits accounts into per-tenant lists, ordered by each tenant's first account."""
+        domain_ids = {}
+        for entry in self.state.values():
+            domain_ids.setdefault(entry['domain'], entry['tenant_id'])
+        groups = {}
+        for name, pwd in accounts:
+            entry = self.state.get(account_key(name))
+            domain = tenant_domain(name)
+            key = entry['tenant_id'] if entry else domain_ids.get(domain, domain)
+            groups.setdefault(key, []).append((name, pwd))
+        return list(groups.values())
+
+    def record(self, username, tenant_id):
+        """Stores the tenant ID seen for an account; rewrites the file only when it changed."""
+        entry = {'tenant_id': tenant_id, 'domain': tenant_domain(username)}
+        with self._lock:
+            if self.state.get(account_key(username)) == entry:
+                return
+            self.state[account_key(username)] = entry
+            write_json_atomic(self.path, self.state)
+
+
+tenant_directory = None # Set from the environment in __main__
+
+
+# --- Incremental Scheduling ---
+class CheckSchedule:
+    """Remembers each account's expiry and last check to decide who is due this run.
+
+    Accounts that failed last time, have no known expiry, or expire within
+    `near_days` are always due. Others are rechecked once half of their margin
+    outside that window has passed, and never later than `refresh_days`.
+    """
+
+    def __init__(self, path, near_days, refresh_days):
+        self.path = path
+        self.near_days = near_days
+        self.refresh_days = refresh_days
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+
+    @classmethod
+    def from_env(cls):
+        if os.environ.get('E5_INCREMENTAL', '0') != '1':
+            return None
+        return cls(os.path.join(STATE_DIR, 'schedule.json'),
+                   parse_number_env('E5_NEAR_EXPIRY_DAYS', NEAR_EXPIRY_DAYS),
+                   parse_number_env('E5_FULL_REFRESH_DAYS', FULL_REFRESH_DAYS))
+
+    def _due(self, entry, today):
+        """Returns (is_due, priority, reason); lower priority values run first."""
+        if not entry:
+            return True, (1, 0), "无历史记录"
+        if entry.get('last_failed'):
+            return True, (0, 0), "上次检查失败"
+        if not entry.get('expiry') or not entry.get('last_success'):
+            return True, (1, 0), "到期日未知"
+        days_left = (date.fromisoformat(entry['expiry']) - today).days
+        since_success = (today - date.fromisoformat(entry['last_success'][:10])).days
+        if days_left <= self.near_days:
+            return True, (2, days_left), f"剩余 {days_left} 天"
+        interval = min(self.refresh_days, max(1, (days_left - self.near_days) // 2))
+        if since_success >= interval:
+            return True, (3, days_left), f"距上次成功检查 {since_success} 天 (间隔 {interval} 天)"
+        return False, None, f"剩余 {days_left} 天, {interval - since_success} 天后再检查"
+
+    def plan(self, accounts, today=None):
+        """Splits accounts into a priority-ordered due list and a skipped list of (name, reason)."""
+        today = today or date.today()
+        due, skipped = [], []
+        for position, (name, pwd) in enumerate(accounts):
+            is_due, priority, reason = self._due(self.state.get(account_key(name)), today)
+            if is_due:
+                due.append((priority, position, name, pwd))
+            else:
+                skipped.append((name, reason))
+        due.sort()
+        return [(name, pwd) for _, _, name, pwd in due], skipped
+
+    def record(self, username, ok, expiry=None):
+        """Stores a check outcome and rewrites the state file so progress survives crashes."""
+        now = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        with self._lock:
+            entry = self.state.setdefault(account_key(username), {})
+            entry['last_check'] = now
+            entry['last_failed'] = not ok
+            if ok:
+                entry['last_success'] = now
+                entry['expiry'] = expiry.isoformat() if expiry else None
+            write_json_atomic(self.path, self.state)
+
+
+schedule = None # Set from the environment in __main__
+
+
+# --- Session Cache ---
+def account_key(username):
+    """Stable, non-reversible identifier for an account, safe for file names."""
+    return hashlib.sha256(username.strip().lower().encode('utf-8')).hexdigest()[:16]
+
+
+# Cookie fields accepted back by Network.setCookies
+COOKIE_PARAM_FIELDS = ('name', 'value', 'domain', 'path', 'secure', 'httpOnly', 'sameSite', 'expires')
+
+# Seeds saved Web Storage into the admin origin before any of its own scripts run
+SEED_STORAGE_JS = """
+(function (origin, storage) {
+    if (location.origin !== origin) return;
+    for (const [area, items] of [[localStorage, storage.local], [sessionStorage, storage.session]]) {
+        for (const key in items) {
+            if (area.getItem(key) === null) area.setItem(key, items[key]);
+        }
+    }
+})(%s, %s);
+"""
+
+
+class SessionCache:
+    """Encrypted per-account store of auth cookies and Web Storage, with a TTL.
+
+    Each account is one Fernet token under `directory`; Fernet's timestamp
+    enforces the TTL, so expired and undecryptable entries are both misses.
+    """
+
+    def __init__(self, directory, secret, ttl_seconds):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        key = base64.urlsafe_b64encode(hashlib.sha256(secret.encode('utf-8')).digest())
+        self._fernet = Fernet(key)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_env(cls):
+        secret = os.environ.get('E5_SESSION_KEY', '')
+        if not secret:
+            return None
+        if Fernet is None:
+            List.append('!! 警告：已设置 E5_SESSION_KEY，但未安装 cryptography，会话缓存已禁用。')
+            return None
+        ttl_hours = parse_number_env('E5_SESSION_TTL_HOURS', SESSION_TTL_HOURS, cast=float)
+        return cls(os.path.join(STATE_DIR, 'sessions'), secret, int(ttl_hours * 3600))
+
+    def _path(self, username):
+        return os.path.join(self.directory, f"{account_key(username)}.session")
+
+    def _count(self, attr):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def load(self, username):
+        """Returns the decrypted session dict, or None if absent, expired or unreadable."""
         try:
-            kmsi_button_no = WebDriverWait(driver, 20).until(
-                EC.element_to_be_clickable((By.ID, "idBtn_Back")) # The "No" button
-            )
+            with open(self._path(username), 'rb') as f:
+                token = f.read()
+            return json.loads(self._fernet.decrypt(token, ttl=self.ttl_seconds))
+        except (OSError, ValueError, InvalidToken):
+            return None
+
+    def discard(self, username):
+        try:
+            os.remove(self._path(username))
+        except OSError:
+            pass
+
+    def save(self, driver, username, log):
+        """Stores the signed-in browser's cookies and admin-origin storage."""
+        try:
+            cookies = driver.execute_cdp_cmd('Network.getAllCookies', {})['cookies']
+            storage = driver.execute_script(
+                "return {origin: location.origin,"
+                " local: Object.assign({}, localStorage), session: Object.assign({}, sessionStorage)};")
+            session = {
+                'cookies': [{k: c[k] for k in COOKIE_PARAM_FIELDS
+                             if k in c and not (k == 'expires' and c.get('session'))}
+                            for c in cookies],
+                'storage': storage,
+            }
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(username)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(self._fernet.encrypt(json.dumps(session).encode('utf-8')))
+            os.replace(tmp_path, path)
+            log.append("  - 已更新加密会话缓存。")
+        except Exception as e:
+            log.append(f"!! 警告: 保存会话缓存失败: {e}")
+
+    def restore(self, driver, username, log):
+        """Loads a cached session and opens the subscriptions page with it.
+
+        Returns True when the Admin Center accepted the session. A rejected
+        session is discarded and the browser reset, ready for a full login.
+        """
+        session = self.load(username)
+        if session is None:
+            self._count('misses')
+            log.append("  - 会话缓存未命中 (不存在、已过期或无法解密)，执行完整登录。")
+            return False
+
+        accepted = False
+        script_id = None
+        try:
+            driver.execute_cdp_cmd('Network.setCookies', {'cookies': session['cookies']})
+            storage = session.get('storage') or {}
+            if storage.get('origin'):
+                script_id = driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {
+                    'source': SEED_STORAGE_JS % (json.dumps(storage['origin']), json.dumps(storage)),
+                })['identifier']
+            driver.get(SUBSCRIPTIONS_URL)
+            # Either the products page renders or the Admin Center bounces us to the login page
+            WebDriverWait(driver, readiness_timeouts['redirect']).until(EC.any_of(
+                EC.all_of(on_host(ADMIN_HOST),
+                          EC.presence_of_element_located((By.CSS_SELECTOR, "div[data-is-scrollable='true']"))),
+                on_host(SIGNIN_HOST)))
+            accepted = on_host(ADMIN_HOST)(driver)
+        except (TimeoutException, WebDriverException, KeyError, TypeError) as e:
+            log.append(f"  - 会话缓存恢复失败: {e}")
+        finally:
+            if script_id is not None:
+                try:
+                    driver.execute_cdp_cmd('Page.removeScriptToEvaluateOnNewDocument', {'identifier': script_id})
+                except WebDriverException:
+                    pass
+
+        if accepted:
+            self._count('hits')
+            log.append("  - 会话缓存命中，跳过登录流程。")
+            return True
+
+        self._count('rejected')
+        log.append("  - 缓存的会话已被拒绝，删除缓存并执行完整登录。")
+        self.discard(username)
+        reset_browser_state(driver)
+        return False
+
+    def summary(self):
+        total = self.hits + self.misses + self.rejected
+        rate = self.hits / total * 100 if total else 0.0
+        return (f"  - 会话缓存: 命中 {self.hits}/{total} ({rate:.0f}%), "
+                f"未命中 {self.misses}, 被拒绝 {self.rejected}。")
+
+
+session_cache = None # Set from the environment in __main__
+
+
+def sign_in(driver, wait, username, password, log, stay_signed_in=False, page_metrics=None, timer=None,
+            pool=None):
+    """Runs the email -> password -> KMSI flow; returns the failed step's name, or None."""
+    enter = timer.enter if timer else (lambda phase: None)
+    enter('email')
+    if pool is not None and pool.take_prenavigated(driver):
+        log.append("  - 浏览器已预先打开登录页。")
+    else:
+        driver.get(LOGIN_URL)
+
+    # --- Login Step 1: Enter Email ---
+    try:
+        email_field = wait.until(EC.visibility_of_element_located((By.ID, "i0116")))
+        if page_metrics:
+            page_metrics.mark('login_page')
+        email_field.send_keys(username)
+        login_page_url = driver.current_url
+        # Use JavaScript click as a fallback if direct click fails
+        next_button = wait.until(EC.element_to_be_clickable((By.ID, "idSIButton9")))
+        driver.execute_script("arguments[0].click();", next_button)
+        # next_button.click() # Direct click sometimes fails
+        log.append("  - 输入邮箱并点击下一步")
+    except (NoSuchElementException, TimeoutException) as e:
+        log.append(f"!! 错误：找不到邮箱输入框或超时。页面可能更改。 {e}")
+        artifact_store.capture(driver, 'email_input', username, log)
+        return 'email' # Stop check for this user
+
+    # Wait for password or other prompts (error text, federated redirect)
+    wait_until_ready(driver, log, 'email', EC.any_of(
+        EC.visibility_of_element_located((By.ID, "i0118")),
+        EC.presence_of_element_located((By.ID, "usernameError")),
+        EC.url_changes(login_page_url)))
+
+    # --- Login Step 2: Enter Password ---
+    enter('password')
+    try:
+        password_field = wait.until(EC.visibility_of_element_located((By.ID, "i0118")))
+        # The field slides in with an animation and drops keystrokes until it has settled
+        wait_until_ready(driver, log, 'password', animations_finished)
+        password_field.send_keys(password)
+        signin_button = wait.until(EC.element_to_be_clickable((By.ID, "idSIButton9")))
+        driver.execute_script("arguments[0].click();", signin_button)
+        # signin_button.click() 
+        log.append("  - 输入密码并点击登录")
+    except (NoSuchElementException, TimeoutException) as e:
+        # Check if it's asking for password again (common if email format was slightly off or domain federated)
+        try:
+            if driver.find_element(By.ID, "i0118").is_displayed():
+               log.append("!! 警告: 似乎仍在密码页面，密码可能错误或登录流程异常。")
+            else: raise NoSuchElementException # Re-raise if not the password field
+        except NoSuchElementException:
+            log.append(f"!! 错误：找不到密码输入框或登录按钮。密码错误或页面结构更改。 {e}")
+        artifact_store.capture(driver, 'password_input', username, log)
+        return 'password'
+
+    # --- Login Step 3: Handle "Stay signed in?" (KMSI) ---
+    enter('kmsi')
+    try:
+        kmsi_button_no = WebDriverWait(driver, 20).until(
+            EC.element_to_be_clickable((By.ID, "idBtn_Back")) # The "No" button
+        )
+        if stay_signed_in:
+            # The session cache needs the persistent cookies that only "Yes" issues
+            driver.execute_script("arguments[0].click();", driver.find_element(By.ID, "idSIButton9"))
+            log.append("  - 处理 '保持登录状态?' -> 是 (会话缓存)")
+        else:
             driver.execute_script("arguments[0].click();", kmsi_button_no)
             # kmsi_button_no.click() 
-            List.append("  - 处理 '保持登录状态?' -> 否")
-        except TimeoutException:
-            List.append("  - 未出现 '保持登录状态?' 弹窗 (或已超时)，继续...")
-            # It's possible login failed silently before this, or the page flow changed.
-            # Check if we are on an expected page (like the admin dashboard)
-            if "admin.microsoft.com" not in driver.current_url:
-                 List.append("!! 警告: 未出现KMSI弹窗，且当前URL不是Admin Center。登录可能失败。")
-                 driver.save_screenshot(f"error_post_login_url_{username}.png")
-                 # Consider returning here if strict login check is needed
-        except NoSuchElementException as e:
-            List.append(f"!! 错误：无法找到 '保持登录状态?' 按钮。 {e}")
-            driver.save_screenshot(f"error_kmsi_button_{username}.png")
-            # Continue cautiously
+            log.append("  - 处理 '保持登录状态?' -> 否")
+    except TimeoutException:
+        log.append("  - 未出现 '保持登录状态?' 弹窗 (或已超时)，继续...")
+        # It's possible login failed silently before this, or the page flow changed.
+        # Check if we are on an expected page (like the admin dashboard)
+        if not on_host(ADMIN_HOST)(driver):
+             log.append("!! 警告: 未出现KMSI弹窗，且当前URL不是Admin Center。登录可能失败。")
+             artifact_store.capture(driver, 'post_login_url', username, log)
+             # Consider returning here if strict login check is needed
+    except NoSuchElementException as e:
+        log.append(f"!! 错误：无法找到 '保持登录状态?' 按钮。 {e}")
+        artifact_store.capture(driver, 'kmsi_button', username, log)
+        # Continue cautiously
+
+    # Give time for potential redirects back to the Admin Center
+    enter('redirect')
+    wait_until_ready(driver, log, 'redirect', EC.all_of(
+        on_host(ADMIN_HOST), document_ready))
+    if page_metrics:
+        page_metrics.mark('sign_in')
+    return None
+
+
+def check_e5_expiry(username, password, log=None, pool=None):
+    """Logs into Microsoft Admin Center and checks E5 subscription expiry.
+
+    Returns an AccountResult. Messages are appended to `log` (a fresh list if
+    omitted) so that parallel workers never write into a shared list. With a
+    `pool` the browser is borrowed from it and handed back instead of being quit.
+    """
+    if log is None:
+        log = []
+    result = AccountResult(account=username)
+    timer = PhaseTimer(result)
+    started = time.monotonic()
+    log.append(f"开始检查账号: {username}")
+    timer.enter('webdriver')
+    driver = pool.acquire(log) if pool else get_webdriver(log)
+    if not driver:
+        timer.stop()
+        result.timings['total'] = round(time.monotonic() - started, 3)
+        log.append(f"!! 检查失败: {username} (WebDriver 初始化失败)")
+        return result.fail('webdriver', log)
+    timer.attach(driver)
+
+    try:
+        # Increased wait time for potentially slow cloud environments
+        wait = WebDriverWait(driver, 45) 
+
+        page_metrics = PageMetrics(driver, log) if PAGE_METRICS else None
+        restored = False
+        if session_cache is not None:
+            timer.enter('session_restore')
+            driver.e5_prenavigated_at = None # Restoring navigates away from the warmed-up login page
+            restored = session_cache.restore(driver, username, log)
+        if not restored:
+            failed_step = sign_in(driver, wait, username, password, log, stay_signed_in=session_cache is not None,
+                                  page_metrics=page_metrics, timer=timer, pool=pool)
+            if failed_step:
+                reason = detect_throttle(driver)
+                if reason:
+                    log.append(f"!! 登录被限流或要求验证 ({reason})。")
+                    return result.fail('throttled', log)
+                return result.fail(failed_step, log) # Stop check for this user
 
         # --- Navigate to Subscriptions Page ---
-        List.append("  - 尝试导航到订阅页面...")
-        time.sleep(random.uniform(4, 7)) # Give time for potential redirects
-        
+        timer.enter('navigation')
+        log.append("  - 尝试导航到订阅页面...")
         try:
-            driver.get(SUBSCRIPTIONS_URL)
+            if not restored: # A restored session is already on the subscriptions page
+                driver.get(SUBSCRIPTIONS_URL)
             # Wait for a reliable element on the subscriptions page.
             # This XPath looks for the main content area of the 'Your products' page
             # Adjust based on UI changes or language differences (e.g., '产品')
             wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "div[data-is-scrollable='true']")))
-            List.append("  - 成功导航到订阅页面")
-            time.sleep(random.uniform(2, 4)) # Let dynamic content load
+            log.append("  - 成功导航到订阅页面")
+            # Let dynamic content load: subscription rows present and network quiet
+            wait_until_ready(driver, log, 'subscriptions', EC.all_of(
+                EC.presence_of_element_located((By.CSS_SELECTOR, SUBSCRIPTION_CARD_SELECTOR)),
+                network_idle()))
+            if page_metrics:
+                page_metrics.mark('subscriptions')
+            result.tenant_id = detect_tenant_id(driver)
+            if session_cache is not None:
+                session_cache.save(driver, username, log)
         except TimeoutException:
-            List.append("!! 错误：导航到订阅页面超时或找不到预期元素。登录失败或页面结构更改。")
-            driver.save_screenshot(f"error_nav_subscriptions_{username}.png")
-            return
-        except
+            log.append("!! 错误：导航到订阅页面超时或找不到预期元素。登录失败或页面结构更改。")
+            artifact_store.capture(driver, 'nav_subscriptions', username, log)
+            reason = detect_throttle(driver)
+            if reason:
+                log.append(f"!! 登录被限流或要求验证 ({reason})。")
+                return result.fail('throttled', log)
+            return result.fail('navigation', log)
+        except Exception as e:
+             log.append(f"!! 导航到订阅页面时发生意外错误: {e}")
+             artifact_store.capture(driver, 'nav_subscriptions', username, log)
+             return result.fail('navigation', log)
+
+        # --- Find Tracked Subscriptions and Expiry Dates ---
+        timer.enter('extraction')
+        try:
+            log.append(f"  - 正在查找订阅: {', '.join(PRODUCT_LABELS)}")
+            
+            # Wait for subscription items/cards to be present, then read them all in one round trip
+            wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, SUBSCRIPTION_CARD_SELECTOR)))
+            subscription_cards = extract_subscription_cards(driver)
+
+            if not subscription_cards:
+                 log.append("!! 警告: 未在页面上检测到任何订阅卡片/行元素。")
+                 artifact_store.capture(driver, 'no_sub_cards', username, log)
+
+            # Every tracked product is read from the same page visit
+            for label, card in match_products(subscription_cards):
+                log.append(f"  - 找到 {label} 订阅卡片: '{card['title']}'")
+                if card['status']:
+                    log.append(f"  - >> 订阅状态: {card['status']}")
+                expiry_text = card_expiry_text(card)
+                if not expiry_text:
+                    log.append(f"  - !! 警告: 在 '{card['title']}' 卡片中未能定位有效期文本。检查HTML结构。")
+                    artifact_store.capture(driver, 'find_expiry_detail', username, log)
+                    continue
+                product = result.add_product(label, card['title'], card['status'], expiry_text)
+                if product['expiry']:
+                    log.append(f"  - >> 有效期信息: {expiry_text} -> 到期日: {product['expiry']} "
+                               f"(剩余 {product['days_remaining']} 天)")
+                else:
+                    log.append(f"  - >> 有效期信息: {expiry_text}")
+                    log.append("  - !! 警告: 无法从有效期文本中解析出日期。")
+
+            missing = [label for label in PRODUCT_LABELS
+                       if not any(product['label'] == label for product in result.products)]
+            if missing and result.products:
+                log.append(f"  - 未找到带有效期信息的订阅: {', '.join(missing)}")
+            if not result.products:
+                log.append(f"!! 未找到与 {', '.join(PRODUCT_LABELS)} 匹配且包含可识别有效期信息的订阅。")
+                artifact_store.capture(driver, 'sub_not_found_or_no_date', username, log)
+                result.fail('extraction', log, status='not_found')
+
+        except TimeoutException:
+            log.append("!! 错误：加载订阅列表超时。")
+            artifact_store.capture(driver, 'loading_subs', username, log)
+            result.fail('extraction', log)
+        except Exception as e:
+            log.append(f"!! 查找订阅或有效期时出错: {e}")
+            artifact_store.capture(driver, 'finding_subs', username, log)
+            result.fail('extraction', log)
+
+    except Exception as e:
+        log.append(f"!! 发生意外的Selenium错误: {e}")
+        result.fail('unexpected', log)
+        # Attempt to capture the page even on unexpected errors
+        artifact_store.capture(driver, 'unexpected', username, log)
+    finally:
+        timer.enter('release')
+        if driver and pool:
+            pool.release(driver, log)
+        elif driver:
+            driver.quit()
+        timer.stop()
+        result.timings['total'] = round(time.monotonic() - started, 3)
+        log.append(f"检查完成: {username}")
+    return result
+
+
+# --- Account Runner ---
+def get_worker_count(env_var='E5_WORKERS'):
+    """Reads the number of concurrent account workers (default 1 = sequential)."""
+    return max(1, parse_number_env(env_var, 1))
+
+
+def parse_accounts(accounts_str):
+    """Parses `email-password&email2-password2...` into a list of (name, pwd)."""
+    accounts = []
+    for i, user_pair in enumerate(accounts_str.split('&')):
+        user_pair = user_pair.strip() # Remove leading/trailing whitespace
+        if not user_pair: continue # Skip empty entries if e.g. trailing & exists
+
+        if '-' not in user_pair:
+            List.append(f'!! 错误：账号 {i+1} 格式不正确 (缺少 "-")，跳过: "{user_pair[:10]}..."')
+            continue
+
+        name, pwd = user_pair.split('-', 1)
+        name = name.strip()
+        pwd = pwd.strip()
+        if not name or not pwd:
+            List.append(f'!! 错误：账号 {i+1} 用户名或密码为空，跳过。')
+            continue
+        accounts.append((name, pwd))
+    return accounts
+
+
+# --- Sharding ---
+def parse_shard(spec):
+    """Parses an `i/N` shard spec (1-based) into (i, N); raises ValueError if invalid."""
+    usage = f"分片参数应为 i/N 且 1 <= i <= N: {spec!r}"
+    index, sep, total = (spec or '').partition('/')
+    try:
+        index, total = int(index), int(total) if sep else 0
+    except ValueError:
+        raise ValueError(usage) from None
+    if not 1 <= index <= total:
+        raise ValueError(usage)
+    return index, total
+
+
+def shard_key(username):
+    """Hash that places an account in a shard: of its email, or of its domain with E5_SHARD_BY=domain."""
+    return account_key(tenant_domain(username) if SHARD_BY == 'domain' else username)
+
+
+def select_shard(accounts, index, total):
+    """Keeps the accounts whose stable hash falls in shard `index` of `total`.
+
+    The hash ignores case and input order, so every matrix job computes the
+    same partition and each account lands in exactly one shard. Accounts of
+    one tenant that share a shard still share one lookup (see run_tenant).
+    """
+    return [(name, pwd) for name, pwd in accounts if int(shard_key(name), 16) % total == index - 1]
+
+
+def check_partition(shard):
+    """Clears the shard's local state if it was built for a different account partition.
+
+    Sessions, schedule entries and checkpoints of accounts that moved to other
+    shards would otherwise linger here, while the accounts that moved in start
+    cold anyway. Tenant IDs don't depend on the partition and are kept. State
+    from before the partition was recorded is assumed to be email-hashed.
+    """
+    path = os.path.join(STATE_DIR, 'partition.json')
+    current = {'shard': f'{shard[0]}/{shard[1]}' if shard else None, 'by': SHARD_BY if shard else None}
+    try:
+        with open(path, encoding='utf-8') as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = {'shard': current['shard'], 'by': 'email' if shard else None}
+    if previous != current:
+        for name in ('sessions', 'checkpoints', 'schedule.json'):
+            target = os.path.join(STATE_DIR, name)
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            elif os.path.exists(target):
+                os.remove(target)
+        List.append(f"账号划分已变更 ({previous.get('shard')} 按 {previous.get('by')} -> "
+                    f"{current['shard']} 按 {current['by']})，已清除本分片的会话缓存、调度状态和检查点。")
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(current, f)
+
+
+def run_account(account_counter, name, pwd, pool=None, prior_failures=None, finalize=True):
+    """Checks one account with its own driver; returns (log lines, AccountResult).
+
+    Failed attempts are retried right away up to the inline retries of their
+    failure phase; the rest of the phase's retry budget, counting
+    `prior_failures` ({phase: count}) from earlier runs, is left to --resume.
+    Every attempt goes to the checkpoint; unless `finalize` is False, the final
+    result is streamed to the results file before this returns.
+    """
+    log = [f'\n======> [账号 {account_counter}: {name}] 开始 <======']
+    domain = tenant_domain(name)
+    failures = dict(prior_failures or {})
+    attempt = sum(failures.values())
+    # Inline retries are counted per run, so a resumed run gets them again
+    run_failures = {}
+    while True:
+        attempt += 1
+        # Wait only if this tenant is backing off; other tenants are unaffected
+        throttle_scheduler.wait_turn(domain, log)
+        try:
+            result = check_e5_expiry(name, pwd, log, pool)
+        except Exception as e:
+            log.append(f'!! 处理账号 {account_counter} ({name}) 时发生未知错误: {e}')
+            result = AccountResult(account=name).fail('unexpected', log)
+        result.attempts = attempt
+        if checkpoint is not None:
+            checkpoint.append(result)
+        if result.status != 'failed':
+            throttle_scheduler.report_ok(domain)
+            break
+
+        phase = result.failure_phase
+        failures[phase] = failures.get(phase, 0) + 1
+        run_failures[phase] = run_failures.get(phase, 0) + 1
+        if phase == 'throttled':
+            throttle_scheduler.report_throttle(domain, result.error, log)
+        if not retry_allowed(failures, phase):
+            log.append(f"  - 阶段 '{phase}' 的重试次数已用尽 ({retry_budget.get(phase, 0)} 次)。")
+            break
+        if not retry_inline(run_failures, phase):
+            log.append(f"  - 阶段 '{phase}' 失败，留待 --resume 重试 "
+                       f"({failures[phase]}/{retry_budget.get(phase, 0)})")
+            break
+        delay = retry_backoff.get(phase, 0) * 2 ** (failures[phase] - 1)
+        log.append(f"  - 阶段 '{phase}' 失败，{delay:.0f} 秒后重试 "
+                   f"({failures[phase]}/{retry_budget.get(phase, 0)})")
+        if delay:
+            time.sleep(delay)
+            run_metrics.record('retry_backoff', delay)
+    log.append(f'======> [账号 {account_counter}: {name}] 结束 <======\n')
+    if finalize:
+        record_final(result)
+    return log, result
+
+
+def record_final(result, alert=True):
+    """Streams a final result to the results file, the run metrics, the notifier and the check schedule.
+
+    `alert=False` is for results replayed from a checkpoint, whose alerts went out in the interrupted run.
+    """
+    if result_writer is not None:
+        result_writer.write(result)
+    run_metrics.record_result(result)
+    if notifier is not None and alert:
+        notifier.result(result)
+    if schedule is not None and result.status != 'skipped':
+        schedule.record(result.account, result.status == 'ok',
+                        date.fromisoformat(result.expiry) if result.expiry else None)
+
+
+def run_tenant(group, pool=None, prior_failures=None):
+    """Looks up one tenant's subscriptions once; returns [(log, AccountResult)] for the group.
+
+    `group` holds (counter, name, pwd) of accounts in the same tenant. They are
+    tried in order until one finds the tracked subscriptions (ok), which is
+    then attributed to the remaining accounts without logging them in. A
+    not_found may only mean the account can't see billing, so the next account
+    is tried and, once one succeeds, the not_found accounts get its result too;
+    failed logins keep their own result.
+    """
+    prior_failures = prior_failures or {}
+    outcomes = []
+    source = None
+    for counter, name, pwd in group:
+        log, result = run_account(counter, name, pwd, pool, prior_failures.get(account_key(name)), finalize=False)
+        outcomes.append((log, result))
+        if result.tenant_id and tenant_directory is not None:
+            tenant_directory.record(result.account, result.tenant_id)
+        if result.status == 'ok':
+            source = result
+            break
+        if len(outcomes) < len(group):
+            log.append("  - 改用同租户的下一个账号查询。")
+    if source is not None:
+        for i, (log, result) in enumerate(outcomes):
+            if result.status == 'not_found':
+                log.append(f"  - {source.account} 查到了订阅，本账号沿用其结果 (本账号可能无权查看订阅)。")
+                outcomes[i] = (log, replace(source, account=result.account, source_account=source.account,
+                                            attempts=result.attempts, timings=result.timings,
+                                            round_trips=result.round_trips))
+                if checkpoint is not None:
+                    checkpoint.append(outcomes[i][1])
+    for _, result in outcomes:
+        record_final(result)
+    if source is None:
+        return outcomes
+
+    for counter, name, _ in group[len(outcomes):]:
+        shared = replace(source, account=name, source_account=source.account, attempts=0,
+                         timings={}, round_trips={})
+        log = [f'\n======> [账号 {counter}: {name}] 与 {source.account} 同租户，沿用其查询结果 <======\n']
+        if checkpoint is not None:
+            checkpoint.append(shared)
+        record_final(shared)
+        outcomes.append((log, shared))
+    return outcomes
+
+
+def run_accounts(accounts, workers=1, pool=None, prior_failures=None):
+    """Runs all accounts on a bounded thread pool, yielding (log, result) per account.
+
+    With a tenant directory, accounts of one tenant run as a group (see
+    run_tenant) and are yielded together in the order of each tenant's first
+    account; otherwise every account is its own group, in input order.
+    `prior_failures` maps account_key() to the {phase: count} of a resumed run.
+    """
+    numbered = {name: counter for counter, (name, _) in enumerate(accounts, 1)}
+    groups = tenant_directory.group(accounts) if tenant_directory is not None else [[a] for a in accounts]
+    groups = [[(numbered[name], name, pwd) for name, pwd in group] for group in groups]
+    if pool is not None:
+        pool.expect(len(groups))
+    workers = max(1, min(workers, len(groups)))
+    if workers == 1:
+        for group in groups:
+            yield from run_tenant(group, pool, prior_failures)
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='e5-worker') as executor:
+        futures = [executor.submit(run_tenant, group, pool, prior_failures) for group in groups]
+        for future in futures:
+            yield from future.result()
+
+
+# --- Notifications ---
+def group_lines(lines, max_chars):
+    """Groups lines into lists that join to at most `max_chars`, cutting overlong lines."""
+    chunk, size = [], 0
+    for line in lines:
+        line = line if len(line) <= max_chars else line[:max_chars - 1] + '…'
+        if chunk and size + len(line) + 1 > max_chars:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    if chunk:
+        yield chunk
+
+
+def chunk_lines(lines, max_chars):
+    """Joins lines into message bodies of at most `max_chars`."""
+    return ('\n'.join(chunk) for chunk in group_lines(lines, max_chars))
+
+
+class Notifier:
+    """Delivers notifications through sendNotify.py on a background thread.
+
+    Urgent results (a failed check, no tracked product found, or an expiry
+    within `urgent_days`) are queued as soon as an account finishes; alerts
+    that pile up while a send is in progress go out as one message. Each send
+    runs with a timeout and failed sends are retried with exponential backoff,
+    so a slow or broken notifier never holds up the checks.
+    """
+
+    def __init__(self, urgent_days, max_chars, retries, timeout, stream=True):
+        self.urgent_days = urgent_days
+        self.max_chars = max_chars
+        self.retries = retries
+        self.timeout = timeout
+        self.stream = stream
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='e5-notify', daemon=True)
+        self._worker.start()
+        self.sent = 0
+        self.alerts = 0
+        self.failures = []
+
+    @classmethod
+    def from_env(cls, stream=True):
+        settings = parse_kv_env('E5_NOTIFY', NOTIFY_DEFAULTS)
+        stream = stream and os.environ.get('E5_NOTIFY_STREAM', '1') != '0'
+        return cls(settings['urgent_days'], int(settings['max_chars']), int(settings['retries']),
+                   settings['timeout'], stream)
+
+    def is_urgent(self, result):
+        if result.status in ('failed', 'not_found'):
+            return True
+        return any(product['days_remaining'] is not None and product['days_remaining'] <= self.urgent_days
+                   for product in result.products)
+
+    def result(self, result):
+        """Queues an alert for an urgent result; routine results wait for the final report."""
+        if self.stream and self.is_urgent(result):
+            self._queue.put(('alert', format_result(asdict(result)).strip()))
+
+    def report(self, title, text):
+        """Queues a report, split into numbered messages of at most `max_chars`."""
+        chunks = list(chunk_lines(text.strip('\n').split('\n'), self.max_chars))
+        for i, chunk in enumerate(chunks, 1):
+            self._queue.put(('message', f"{title} ({i}/{len(chunks)})" if len(chunks) > 1 else title, chunk))
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            alerts = [item[1] for item in items if item and item[0] == 'alert']
+            # Each alert spans several lines, so count alerts rather than lines
+            for chunk in group_lines(alerts, self.max_chars):
+                if self._deliver(f"Microsoft E5 订阅告警 ({len(chunk)} 个账号)", '\n'.join(chunk)):
+                    self.alerts += 1
+            for item in items:
+                if item is None:
+                    return
+                if item[0] == 'message':
+                    self._deliver(item[1], item[2])
+
+    def _deliver(self, title, body):
+        """Sends one message, retrying on errors (not on timeouts); returns True once it went out."""
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(2 ** attempt)
+            outcome = {}
+
+            def target():
+                try:
+                    send(title, body)
+                except Exception as e:
+                    outcome['error'] = e
+
+            sender = threading.Thread(target=target, name='e5-notify-send', daemon=True)
+            sender.start()
+            sender.join(self.timeout)
+            if sender.is_alive():
+                # The send may still go through; retrying now could deliver it twice
+                error = f"超时 ({self.timeout:g} 秒, 未重试)"
+                break
+            if 'error' in outcome:
+                error = outcome['error']
+            else:
+                self.sent += 1
+                return True
+        self.failures.append(f"{title}: {error}")
+        print(f"!! 发送通知 '{title}' 失败 (共尝试 {attempt + 1} 次): {error}")
+        return False
+
+    def close(self):
+        """Waits for everything queued to be sent; returns a summary line."""
+        self._queue.put(None)
+        self._worker.join()
+        line = f"通知: 已发送 {self.sent} 条 (其中即时告警 {self.alerts} 条)"
+        if self.failures:
+            line += f", 失败 {len(self.failures)} 条"
+        return line
+
+
+notifier = None # Set in __main__
+
+
+def send_report(title, final_output, notifier=None):
+    """Prints the summary and sends it through sendNotify.py if configured.
+
+    The report goes out through `notifier` (a fresh one if omitted), which is
+    closed afterwards so every queued message is delivered before this returns.
+    """
+    print("--- Script Execution Summary ---")
+    print(final_output)
+    print("--- End Summary ---")
+
+    # Send notification using sendNotify.py if configured
+    notifier = notifier or Notifier.from_env(stream=False)
+    notifier.report(title, final_output)
+    print(notifier.close())
+
+
+if __name__ == '__main__':
+    # --- Random Delay (Less important in Actions, but harmless) ---
+    # delay_sec = random.randint(1, 5) 
+    # List.append(f'随机延时 {delay_sec} 秒')
+    # time.sleep(delay_sec)
+
+    # --- Command Line ---
+    parser = argparse.ArgumentParser(description='检查 Microsoft 365 E5 订阅有效期')
+    parser.add_argument('--shard', metavar='i/N', default=os.environ.get('E5_SHARD') or None,
+                        help='只检查第 i 个分片 (共 N 个, 按邮箱哈希划分, E5_SHARD_BY=domain 时按域名)，结果由 --merge 汇总后统一通知')
+    parser.add_argument('--merge', nargs='+', metavar='FILE',
+                        help='合并各分片的结果文件，生成一份报告并发送一次通知')
+    parser.add_argument('--resume', nargs='?', const='', metavar='RUN_ID',
+                        help='继续被中断的运行 (默认: E5_RUN_ID/GITHUB_RUN_ID 或最近一次运行)，'
+                             '跳过已完成的账号，仅在重试预算内重试失败或未完成的账号')
+    args = parser.parse_args()
+    shard = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    
+    # --- Environment Variable Processing ---
+    account_env_var = 'MS_E5_ACCOUNTS' 
+    if args.merge:
+        # Cross-check against the configured accounts when the secret is available
+        expected = None
+        if os.environ.get(account_env_var):
+            expected = [name for name, _ in parse_accounts(os.environ[account_env_var])]
+        try:
+            List.extend(merge_results(args.merge, RESULTS_FILE, expected))
+        except ValueError as e:
+            parser.error(str(e))
+        List.append(summarize_results(RESULTS_FILE))
+        send_report('Microsoft E5 订阅检查报告', '\n'.join(List))
+
+    elif account_env_var in os.environ:
+        accounts_str = os.environ[account_env_var]
+        if not accounts_str:
+             List.append(f'!! 错误：环境变量 {account_env_var} 为空。请在 GitHub Secrets 中设置。')
+        else:
+            users = accounts_str.split('&')
+            List.append(f'检测到 {len(users)} 个账号配置。')
+            accounts = parse_accounts(accounts_str)
+            if shard:
+                accounts = select_shard(accounts, *shard)
+                List.append(f'分片 {shard[0]}/{shard[1]}: 本分片负责 {len(accounts)} 个账号。')
+            check_partition(shard)
+
+            session_cache = SessionCache.from_env()
+            result_writer = ResultWriter(RESULTS_FILE)
+            # Urgent results are sent while the run goes on (E5_NOTIFY_STREAM=0 to wait for the report)
+            notifier = Notifier.from_env()
+
+            # Only check accounts that are due, most urgent first (E5_INCREMENTAL=1)
+            schedule = CheckSchedule.from_env()
+
+            # --- Checkpoint / Resume ---
+            run_id = RUN_ID
+            if args.resume is not None:
+                run_id = (args.resume or os.environ.get('E5_RUN_ID') or os.environ.get('GITHUB_RUN_ID')
+                          or Checkpoint.latest_run_id() or RUN_ID)
+            checkpoint = Checkpoint(run_id)
+            prior_failures = {}
+            if args.resume is not None:
+                progress = checkpoint.load()
+                remaining = []
+                for name, pwd in accounts:
+                    entry = progress.get(account_key(name))
+                    last = entry['last'] if entry else None
+                    if last is None or (last['status'] == 'failed'
+                                        and retry_allowed(entry['failures'], last['failure_phase'])):
+                        remaining.append((name, pwd))
+                        prior_failures[account_key(name)] = entry['failures'] if entry else {}
+                    else:
+                        # Finished (or out of retries) in the interrupted run: report and count it as it was
+                        record_final(result_from_record(last), alert=False)
+                List.append(f'恢复运行 {run_id}: {len(accounts) - len(remaining)} 个账号已完成, '
+                            f'{len(remaining)} 个账号待检查或重试。')
+                accounts = remaining
+            else:
+                checkpoint.prune()
+
+            if schedule is not None:
+                accounts, skipped = schedule.plan(accounts)
+                List.append(f'增量调度: 本次检查 {len(accounts)} 个账号, 跳过 {len(skipped)} 个尚未到期的账号。')
+                for name, reason in skipped:
+                    skipped_result = AccountResult(account=name, status='skipped', error=reason)
+                    record_final(skipped_result)
+                    checkpoint.append(skipped_result)
+
+            # Accounts of one tenant share a single subscription lookup (E5_TENANT_DEDUP=0 to disable)
+            tenant_directory = TenantDirectory.from_env()
+            if tenant_directory is not None:
+                tenants = len(tenant_directory.group(accounts))
+                if tenants < len(accounts):
+                    List.append(f'租户去重: {len(accounts)} 个账号属于 {tenants} 个租户，每个租户只查询一次。')
+
+            workers = get_worker_count()
+            if workers > 1:
+                List.append(f'并发模式: 最多 {min(workers, len(accounts))} 个 WebDriver 同时运行。')
+
+            # One pooled browser per worker, reset between accounts (E5_REUSE_BROWSER=0 to disable)
+            pool = None
+            if os.environ.get('E5_REUSE_BROWSER', '1') != '0':
+                pool = DriverPool.from_env(min(workers, max(len(accounts), 1)))
+
+            # Each worker owns its driver and its log; detailed logs go straight to the
+            # console in account order and only the result records are kept (on disk).
+            print("--- Account Check Logs ---")
+            try:
+                for account_log, _ in run_accounts(accounts, workers, pool, prior_failures):
+                    print('\n'.join(account_log))
+            finally:
+                if pool:
+                    pool.close()
+                result_writer.close()
+                checkpoint.close()
+                artifact_store.close()
+            if pool:
+                List.append(pool.summary())
+            List.append(wait_stats.summary())
+            List.append(throttle_scheduler.summary())
+            if PAGE_METRICS:
+                List.append(page_load_stats.summary())
+            if artifact_store.saved or artifact_store.duplicates or artifact_store.over_budget:
+                List.append(artifact_store.summary())
+            try:
+                List.append(run_metrics.export(METRICS_PREFIX))
+            except OSError as e:
+                List.append(f"!! 写入指标文件失败: {e}")
+            if session_cache is not None:
+                List.append(session_cache.summary())
+
+            # --- Final Output and Notification ---
+            List.append(summarize_results(RESULTS_FILE))
+            final_output = '\n'.join(List)
+            if shard:
+                # Shards only print and stream alerts; the merge step sends the combined report
+                print("--- Script Execution Summary ---")
+                print(final_output)
+                print("--- End Summary ---")
+                print(notifier.close())
+            else:
+                send_report('Microsoft E5 订阅检查报告', final_output, notifier)
+            
+    else:
+        print(f'!! 错误：未找到环境变量 {account_env_var}。请在 GitHub Secrets 中配置。')
+        List.append(f'错误：未找到环境变量 {account_env_var}。')
+        # Send notification about missing configuration
+        try:
+            send('Microsoft E5 订阅检查错误', f'错误：未配置 GitHub Secret {account_env_var}')
+        except NameError:
+            pass
+        except Exception as notify_err:
+            print(f"!! 发送配置错误通知时出错: {notify_err}")
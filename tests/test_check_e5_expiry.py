@@ -0,0 +1,99 @@
+import os
+import sys
+from datetime import date
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import check_e5_expiry as e5  # noqa: E402
+
+
+# --- Expiry Date Parsing ---
+@pytest.mark.parametrize('text, date_order, expected', [
+    ('Expires on 03/04/2026', 'mdy', date(2026, 3, 4)),
+    ('Expires on 03/04/2026', 'dmy', date(2026, 4, 3)),
+    ('Expires on 25/12/2026', 'mdy', date(2026, 12, 25)), # a first field above 12 is the day
+    ('Expires on 12/25/2026', 'dmy', date(2026, 12, 25)),
+    ('Expires on May 6, 2026', 'mdy', date(2026, 5, 6)),
+    ('End date: 2026-05-06', 'dmy', date(2026, 5, 6)),
+    ('订阅将于 2026年5月6日 到期', 'mdy', date(2026, 5, 6)),
+    ('2026년 5월 6일에 만료됩니다', 'mdy', date(2026, 5, 6)),
+    ('Läuft ab am 06.05.2026', 'mdy', date(2026, 5, 6)),
+    ('Läuft am 6. Mai 2026 ab', 'mdy', date(2026, 5, 6)),
+    ('Expire le 6 févr. 2026', 'mdy', date(2026, 2, 6)),
+    ('Vence el 6 de mayo de 2026', 'mdy', date(2026, 5, 6)),
+    ('Expires on 02/30/2026', 'mdy', None), # no such day
+    ('Expires in 30 days', 'mdy', None),
+    (None, 'mdy', None),
+])
+def test_parse_expiry_date(monkeypatch, text, date_order, expected):
+    monkeypatch.setattr(e5, 'DATE_ORDER', date_order)
+    assert e5.parse_expiry_date(text) == expected
+
+
+@pytest.mark.parametrize('card, expected', [
+    ({'text': 'Microsoft 365 E5\nActive\nExpires on May 6, 2026'}, 'Expires on May 6, 2026'),
+    # A dated line wins over an undated one and over the end-date field
+    ({'text': 'Expires in 30 days\nEnd date: 06.05.2026', 'end_date': 'soon'}, 'End date: 06.05.2026'),
+    ({'text': 'Expires in 30 days', 'end_date': '2026-05-06'}, '2026-05-06'),
+    ({'text': 'Microsoft 365 E5\nExpires in 30 days'}, 'Expires in 30 days'),
+    ({'text': '만료일: 2026년 5월 6일'}, '만료일: 2026년 5월 6일'),
+    ({'text': 'Microsoft 365 E5\nActive'}, None),
+    ({}, None),
+])
+def test_card_expiry_text(card, expected):
+    assert e5.card_expiry_text(card) == expected
+
+
+# --- Sharding ---
+@pytest.mark.parametrize('spec, expected', [('1/1', (1, 1)), ('2/3', (2, 3)), ('3/3', (3, 3))])
+def test_parse_shard(spec, expected):
+    assert e5.parse_shard(spec) == expected
+
+
+@pytest.mark.parametrize('spec', ['a', '2', '0/3', '4/3', '1/x', '', None])
+def test_parse_shard_rejects_with_usage(spec):
+    with pytest.raises(ValueError, match='i/N'):
+        e5.parse_shard(spec)
+
+
+ACCOUNTS = [(f'user{i}@tenant{i % 7}.onmicrosoft.com', 'pw') for i in range(60)]
+
+
+@pytest.mark.parametrize('shard_by', ['email', 'domain'])
+@pytest.mark.parametrize('total', [1, 2, 3, 5])
+def test_select_shard_partitions_accounts(monkeypatch, shard_by, total):
+    monkeypatch.setattr(e5, 'SHARD_BY', shard_by)
+    shards = [e5.select_shard(ACCOUNTS, index, total) for index in range(1, total + 1)]
+    assert sorted(account for shard in shards for account in shard) == sorted(ACCOUNTS)
+    # Input order and case don't move an account to another shard
+    reordered = [(name.upper(), pwd) for name, pwd in reversed(ACCOUNTS)]
+    for index, shard in enumerate(shards, 1):
+        assert sorted(name.lower() for name, _ in e5.select_shard(reordered, index, total)) == \
+            sorted(name for name, _ in shard)
+    if shard_by == 'domain':
+        # A tenant's accounts stay together so they can share one lookup
+        shard_of = {}
+        for index, shard in enumerate(shards):
+            for name, _ in shard:
+                assert shard_of.setdefault(e5.tenant_domain(name), index) == index
+
+
+# --- Incremental Schedule ---
+@pytest.mark.parametrize('entry, expected', [
+    (None, (True, (1, 0))),
+    ({'last_failed': True, 'expiry': '2026-12-31', 'last_success': '2025-12-31'}, (True, (0, 0))),
+    ({'last_success': '2025-12-31T08:00:00'}, (True, (1, 0))),
+    ({'expiry': '2026-01-10', 'last_success': '2025-12-31T08:00:00'}, (True, (2, 9))),
+    # 60 days left: rechecked every min(refresh_days, (60 - 14) // 2) = 7 days
+    ({'expiry': '2026-03-02', 'last_success': '2025-12-26T08:00:00'}, (False, None)),
+    ({'expiry': '2026-03-02', 'last_success': '2025-12-25T08:00:00'}, (True, (3, 60))),
+    # 24 days left: every (24 - 14) // 2 = 5 days
+    ({'expiry': '2026-01-25', 'last_success': '2025-12-28T08:00:00'}, (False, None)),
+    ({'expiry': '2026-01-25', 'last_success': '2025-12-27T08:00:00'}, (True, (3, 24))),
+])
+def test_schedule_due(tmp_path, entry, expected):
+    schedule = e5.CheckSchedule(str(tmp_path / 'schedule.json'), near_days=14, refresh_days=7)
+    is_due, priority, _reason = schedule._due(entry, date(2026, 1, 1))
+    assert (is_due, priority) == expected